@@ -19,9 +19,12 @@ import os
 from flask import Flask
 from flask_cors import CORS
 from dotenv import load_dotenv
-from .lists_renewal import start_renewal_thread
+from .renewal_scheduler import start_renewal_scheduler
+from .list_publisher import start_publisher_thread
+from .list_management import replay_journal, start_checkpoint_thread, start_rehydration
 from flask_swagger_ui import get_swaggerui_blueprint
 from app.config_service import ConfService as cfgservice
+from app import metrics
 
 
 def create_app():
@@ -44,11 +47,18 @@ def create_app():
 
     # Register blueprints
     app.register_blueprint(status_list_endpoints.token)
+    app.register_blueprint(status_list_endpoints.identifier)
     app.register_blueprint(swagger_ui_blueprint, url_prefix=SWAGGER_URL)
 
+    metrics.init_app(app)
+
     app.debug = True
 
-    start_renewal_thread()
+    replay_journal()
+    start_rehydration()
+    start_checkpoint_thread()
+    start_publisher_thread()
+    start_renewal_scheduler()
 
     return app
 
@@ -0,0 +1,141 @@
+# coding: latin-1
+###############################################################################
+# Copyright (c) 2023 European Commission
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+###############################################################################
+"""
+In-memory cache of the signed artifacts served over HTTP.
+
+Artifacts up to artifact_cache_item_bytes are kept in memory, in a LRU bounded by
+artifact_cache_bytes. Larger ones only have their ETag cached, and are streamed from
+disk. Entries are checked against the file on disk, so artifacts written by another
+process are never served stale.
+"""
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+from app.config_service import ConfService as cfgservice
+
+# Approximate memory used by an entry besides the artifact bytes
+ENTRY_OVERHEAD = 256
+
+# (file state, etag, bytes or None) of the artifacts, by path
+artifacts = OrderedDict()
+
+artifacts_lock = threading.Lock()
+
+# Bytes used by the cached artifacts
+cached_bytes = 0
+
+
+def _file_state(stat) -> tuple:
+    """Returns the values used to detect a change of a file on disk"""
+    return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+
+def _entry_size(entry: tuple) -> int:
+    """Returns the memory accounted for a cache entry"""
+    return ENTRY_OVERHEAD + (len(entry[2]) if entry[2] is not None else 0)
+
+
+def _store(path: str, entry: tuple):
+    """Adds an entry to the cache, evicting the least recently used ones"""
+    global cached_bytes
+
+    with artifacts_lock:
+        previous = artifacts.pop(path, None)
+        if previous is not None:
+            cached_bytes -= _entry_size(previous)
+
+        artifacts[path] = entry
+        cached_bytes += _entry_size(entry)
+
+        while cached_bytes > cfgservice.artifact_cache_bytes and len(artifacts) > 1:
+            _, evicted = artifacts.popitem(last=False)
+            cached_bytes -= _entry_size(evicted)
+
+
+def invalidate_artifacts(paths):
+    """
+    Drops artifacts from the cache, after they were written
+
+    Args:
+        paths (iterable): paths of the artifacts
+    """
+
+    global cached_bytes
+
+    with artifacts_lock:
+        for path in paths:
+            entry = artifacts.pop(path, None)
+            if entry is not None:
+                cached_bytes -= _entry_size(entry)
+
+
+def get_artifact(path: str) -> tuple:
+    """
+    Returns an artifact, from memory if it is cached and unchanged on disk
+
+    Args:
+        path (str): path of the artifact
+
+    Returns:
+        tuple: strong ETag (sha256 of the content), the content for artifacts kept
+        in memory, else None and the open file, to be closed by the caller
+    """
+
+    try:
+        state = _file_state(os.stat(path))
+    except FileNotFoundError:
+        invalidate_artifacts([path])
+        raise
+
+    with artifacts_lock:
+        entry = artifacts.get(path)
+        if entry is not None and entry[0] == state:
+            artifacts.move_to_end(path)
+
+    if entry is not None and entry[0] == state and entry[2] is not None:
+        return entry[1], entry[2], None
+
+    f = open(path, "rb")
+
+    try:
+        # The file may have been replaced since it was checked
+        state = _file_state(os.fstat(f.fileno()))
+
+        if entry is not None and entry[0] == state:
+            return entry[1], None, f
+
+        if state[2] <= cfgservice.artifact_cache_item_bytes:
+            data = f.read()
+            etag = hashlib.sha256(data).hexdigest()
+            f.close()
+            _store(path, (state, etag, data))
+            return etag, data, None
+
+        digest = hashlib.sha256()
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+        f.seek(0)
+
+        _store(path, (state, digest.hexdigest(), None))
+
+        return digest.hexdigest(), None, f
+    except BaseException:
+        f.close()
+        raise
@@ -0,0 +1,359 @@
+# coding: latin-1
+###############################################################################
+# Copyright (c) 2023 European Commission
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+###############################################################################
+"""
+Content addressed store of the list backups.
+
+Files are stored once in backup_dir, whatever the number of snapshots using them:
+
+    blobs/<sha256[:2]>/<sha256>    content of a backed up file
+    snapshots/<timestamp>.json     path, relative to status_list_dir, and sha256 of
+                                   each file of the lists backed up so far, as of a
+                                   renewal run
+    pruned                         touched when the backups were last pruned
+
+Blobs are hardlinks of the backed up files when possible. Lists are always written
+aside and renamed, so a linked blob is never modified afterwards.
+
+Renewals, in any process, hold a shared lock on backup.lock from the first blob they
+store until their manifest is written, and pruning holds it exclusively, so that a
+blob is never removed before the manifest using it exists.
+"""
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+from app.config_service import ConfService as cfgservice
+from app.list_storage import write_file
+
+SNAPSHOT_FORMAT = "%Y-%m-%d_%H-%M-%S"
+
+LOCK_FILE = "backup.lock"
+
+PRUNED_FILE = "pruned"
+
+
+@contextmanager
+def backup_lock(exclusive: bool = False):
+    """
+    Locks backup_dir across processes until the block exits
+
+    Args:
+        exclusive (bool): whether to lock exclusively, to prune, or shared, to store
+        blobs and write the manifest using them
+    """
+
+    os.makedirs(cfgservice.backup_dir, exist_ok=True)
+
+    with open(os.path.join(cfgservice.backup_dir, LOCK_FILE), "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        yield
+
+
+def blob_path(digest: str) -> str:
+    """
+    Returns the path of a blob
+
+    Args:
+        digest (str): hex encoded sha256 of the content
+
+    Returns:
+        str: path of the blob in backup_dir
+    """
+
+    return os.path.join(cfgservice.backup_dir, "blobs", digest[:2], digest)
+
+
+def snapshot_path(name: str) -> str:
+    """
+    Returns the path of the manifest of a snapshot
+
+    Args:
+        name (str): timestamp of the snapshot
+
+    Returns:
+        str: path of the manifest in backup_dir
+    """
+
+    return os.path.join(cfgservice.backup_dir, "snapshots", name + ".json")
+
+
+def file_digest(f) -> str:
+    """
+    Returns the sha256 of an open file
+
+    Args:
+        f (file): the file, opened in binary mode and read from its start
+
+    Returns:
+        str: hex encoded sha256
+    """
+
+    digest = hashlib.sha256()
+
+    for chunk in iter(lambda: f.read(1 << 20), b""):
+        digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+def store_blob(path: str) -> str:
+    """
+    Stores a file in the blob store, unless the same content is already there. The
+    file may be replaced meanwhile by a new version: the blob is always the content
+    that was hashed, read from the file opened once.
+
+    Args:
+        path (str): path of the file
+
+    Returns:
+        str: hex encoded sha256 of the file
+    """
+
+    with open(path, "rb") as f:
+        digest = file_digest(f)
+        target = blob_path(digest)
+
+        if os.path.exists(target):
+            return digest
+
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+
+        try:
+            os.link(path, target)
+        except FileExistsError:
+            # Stored meanwhile by another renewal worker
+            return digest
+        except OSError:
+            # Not on the same file system, or no hardlink support
+            pass
+        else:
+            if os.stat(target).st_ino == os.fstat(f.fileno()).st_ino:
+                return digest
+
+            # The path was replaced since it was hashed, the link is another content
+            os.remove(target)
+
+        f.seek(0)
+        temporary = f"{target}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temporary, "wb") as blob:
+            shutil.copyfileobj(f, blob)
+        os.replace(temporary, target)
+
+    return digest
+
+
+def backup_files(paths: list) -> dict:
+    """
+    Stores files in the blob store
+
+    Args:
+        paths (list): paths of the files, in status_list_dir
+
+    Returns:
+        dict: sha256 of the files, by path relative to status_list_dir
+    """
+
+    return {
+        os.path.relpath(path, cfgservice.status_list_dir): store_blob(path)
+        for path in paths
+    }
+
+
+def write_snapshot(name: str, files: dict):
+    """
+    Writes the manifest of a snapshot
+
+    Args:
+        name (str): timestamp of the snapshot
+        files (dict): output of backup_files, for every file of the snapshot
+    """
+
+    path = snapshot_path(name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    write_file(path, json.dumps(files, sort_keys=True))
+
+
+def complete_snapshot(files: dict) -> dict:
+    """
+    Completes the files backed up by a renewal run with those of the latest snapshot
+    that weren't backed up again and still exist, so that every snapshot covers every
+    list. Their blobs are already stored, only the manifest grows.
+
+    Args:
+        files (dict): output of backup_files, for the lists renewed
+
+    Returns:
+        dict: sha256 of the files of the snapshot, by path relative to
+        status_list_dir
+    """
+
+    snapshot = {}
+    names = list_snapshots()
+
+    if names:
+        try:
+            previous = read_snapshot(names[-1])
+        except (OSError, ValueError):
+            cfgservice.app_logger.warning(
+                f"Unable to read the snapshot {names[-1]}", exc_info=True
+            )
+            previous = {}
+
+        for relative_path, digest in previous.items():
+            # Lists removed since, as expired, are left out
+            if os.path.exists(os.path.join(cfgservice.status_list_dir, relative_path)):
+                snapshot[relative_path] = digest
+
+    snapshot.update(files)
+
+    return snapshot
+
+
+def read_snapshot(name: str) -> dict:
+    """
+    Reads the manifest of a snapshot
+
+    Args:
+        name (str): timestamp of the snapshot
+
+    Returns:
+        dict: sha256 of the files, by path relative to status_list_dir
+    """
+
+    with open(snapshot_path(name), "r") as f:
+        return json.load(f)
+
+
+def list_snapshots() -> list:
+    """
+    Returns the names of the snapshots, oldest first
+
+    Returns:
+        list: timestamps of the snapshots
+    """
+
+    try:
+        names = os.listdir(os.path.join(cfgservice.backup_dir, "snapshots"))
+    except FileNotFoundError:
+        return []
+
+    return sorted(name[: -len(".json")] for name in names if name.endswith(".json"))
+
+
+def restore_snapshot(name: str, target_dir: str) -> int:
+    """
+    Copies the files of a snapshot, every list as last backed up when the snapshot
+    was written, to a directory, laid out as in status_list_dir
+
+    Args:
+        name (str): timestamp of the snapshot
+        target_dir (str): directory to restore to
+
+    Returns:
+        int: number of files restored
+    """
+
+    files = read_snapshot(name)
+
+    for relative_path, digest in files.items():
+        path = os.path.join(target_dir, relative_path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        shutil.copyfile(blob_path(digest), path)
+
+    return len(files)
+
+
+def prune_backups(now: datetime = None) -> int:
+    """
+    Removes the snapshots older than backup_retention_days, but the latest one, and
+    the blobs no longer used by any snapshot
+
+    Args:
+        now (datetime): current time
+
+    Returns:
+        int: number of snapshots removed
+    """
+
+    with backup_lock(exclusive=True):
+        removed = _prune_backups(now)
+        write_file(
+            os.path.join(cfgservice.backup_dir, PRUNED_FILE),
+            datetime.now().isoformat(timespec="seconds"),
+        )
+
+    return removed
+
+
+def prune_backups_if_due() -> int:
+    """
+    Prunes the backups unless they were pruned, by any process, less than
+    backup_prune_interval ago
+
+    Returns:
+        int: number of snapshots removed
+    """
+
+    try:
+        last = os.stat(os.path.join(cfgservice.backup_dir, PRUNED_FILE)).st_mtime
+    except FileNotFoundError:
+        last = 0
+
+    if time.time() - last < cfgservice.backup_prune_interval:
+        return 0
+
+    return prune_backups()
+
+
+def _prune_backups(now: datetime) -> int:
+    """Removes the old snapshots and unused blobs, holding backup_lock exclusively"""
+    limit = (now or datetime.now()) - timedelta(days=cfgservice.backup_retention_days)
+    removed = 0
+
+    # The latest snapshot is completed by the next renewal run
+    for name in list_snapshots()[:-1]:
+        try:
+            if datetime.strptime(name, SNAPSHOT_FORMAT) >= limit:
+                continue
+        except ValueError:
+            continue
+
+        os.remove(snapshot_path(name))
+        removed += 1
+
+    if removed == 0:
+        return 0
+
+    used = set()
+    for name in list_snapshots():
+        used.update(read_snapshot(name).values())
+
+    for root, _, files in os.walk(os.path.join(cfgservice.backup_dir, "blobs")):
+        for file in files:
+            if file not in used:
+                os.remove(os.path.join(root, file))
+
+    cfgservice.app_logger.info(f"Pruned {removed} backup snapshots")
+
+    return removed
@@ -26,10 +26,96 @@ class ConfService:
     # Token status list size (Bytes)
     token_status_list_size = 10000
 
+    # Sizes of the lists of some countries and doctypes, by (country, doctype) or by
+    # doctype, instead of token_status_list_size
+    token_status_list_sizes = {}
+
+    # Size new lists from the issuance rate of the list they replace, so that they last
+    # about adaptive_list_lifetime seconds, between min_list_size and max_list_size
+    adaptive_list_size = False
+    adaptive_list_lifetime = 30 * 24 * 3600
+    min_list_size = 1024
+    max_list_size = 1024 * 1024
+
+    # Bits per status (1, 2, 4 or 8) of the lists of each doctype, 1 if not listed.
+    # With 2 bits or more, statuses other than invalid (1) can be set, e.g. suspended (2)
+    # which can be set back to valid (0).
+    status_list_bits = {}
+
     status_list_dir = "/var/opt/status_lists"
 
     backup_dir = "/var/opt/status_list_backup"
 
+    # Days a backup snapshot is kept before being pruned
+    backup_retention_days = 30
+
+    # Minimum time (seconds) between two prunes of the backups, which read every
+    # snapshot manifest
+    backup_prune_interval = 86400
+
+    # Minimum time (seconds) between two re-signs of a list after status changes.
+    # Changes within this interval are published together; 0 publishes immediately.
+    publish_interval = 10
+
+    # Seconds between two saves of the lists changed since, whose changes are kept
+    # in the journal meanwhile
+    journal_checkpoint_interval = 5
+
+    # Requests taking indexes or changing statuses return once their journal record
+    # is synced to disk, concurrent requests sharing an fsync. False opts out of
+    # durability: a crash of the host may lose the changes of the last seconds, and
+    # indexes already handed out may be handed out again
+    journal_fsync = True
+
+    # Maximum number of indexes taken by a single /take_batch request
+    max_batch_size = 1000
+
+    # Fill ratio of a list from which the next list is created and signed in advance
+    next_list_threshold = 0.9
+
+    # Number of threads scanning status_list_dir at startup for lists to resume
+    rehydration_workers = 8
+
+    # Number of parsed lists kept in memory to answer /get requests
+    list_cache_size = 256
+
+    # Number of compressed token status lists kept in memory, reused to sign lists
+    # whose statuses didn't change
+    compressed_list_cache_size = 1024
+
+    # Size in bytes of the blocks of the token status lists compressed separately, so
+    # that publishing a list after a change only compresses the blocks that changed.
+    # Smaller lists are compressed whole.
+    compression_block_size = 16384
+
+    # Number of list state files kept memory mapped to answer /get on token status lists
+    mapped_lists_size = 1024
+
+    # Number of workers signing lists in parallel during the renewal, and whether
+    # they are threads ("thread") or processes ("process")
+    renewal_workers = os.cpu_count() or 1
+    renewal_executor = "thread"
+
+    # Bytes of signed artifacts kept in memory to serve the lists, and largest artifact
+    # kept in memory; larger ones are streamed from disk
+    artifact_cache_bytes = 64 * 1024 * 1024
+    artifact_cache_item_bytes = 1024 * 1024
+
+    # Seconds relying parties may cache a list for: ttl claim of the signed lists and
+    # max-age of their HTTP responses
+    list_ttl = 3600
+
+    # Seconds a signed list is served before being signed again
+    signature_validity = 43200
+
+    # Fraction of signature_validity by which renewals are spread, so that lists
+    # signed together are not all renewed together
+    renewal_spread = 0.1
+
+    # Seconds between two scans of status_list_dir for new, changed and expired lists,
+    # and between two attempts of the other processes to become the renewal leader
+    renewal_interval = 300
+
     countries = {
         "FC":{
             "privKey":"/etc/eudiw/pid-issuer/privKey/PID-DS-0001_UT.pem",
@@ -15,17 +15,15 @@
 # limitations under the License.
 #
 ###############################################################################
-import base64
 import cbor2, jwt
 from datetime import datetime, timedelta
 import time
 
 from cryptography.hazmat.primitives.asymmetric import ec
 from cryptography.hazmat.primitives import hashes
-from cryptography.hazmat.primitives import serialization
-from cryptography.hazmat.backends import default_backend
-from cryptography import x509
 from app.config_service import ConfService as cfgservice
+from app import metrics
+from app.signer_registry import get_signer
 
 
 def identifier_list_jwt_format(
@@ -41,29 +39,7 @@ def identifier_list_jwt_format(
         str: The encoded JWT
     """
 
-    # private_key = ec.generate_private_key(ec.SECP256R1())
-
-    with open(cfgservice.countries[country]["privKey"], "rb") as key_file:
-        private_key = serialization.load_pem_private_key(
-            key_file.read(),
-            password=(
-                cfgservice.countries[country]["privkey_passwd"]
-                if cfgservice.countries[country]["privkey_passwd"] is not None
-                else None
-            ),
-            backend=default_backend(),
-        )
-
-    with open(cfgservice.countries[country]["cert"], "rb") as file:
-        certificate = file.read()
-
-    cert = x509.load_der_x509_certificate(certificate)
-
-    _cert = cert.public_bytes(getattr(serialization.Encoding, "DER"))
-
-    _cert_b64 = base64.b64encode(_cert).decode()
-
-    print("\ncert_b64", _cert_b64, flush=True)
+    signer = get_signer(country)
 
     payload = {
         "iss": cfgservice.service_url[:-1],
@@ -73,9 +49,13 @@ def identifier_list_jwt_format(
         "identifier_list": identifier_list,
     }
 
-    headers = {"typ": "application/identifierlist+jwt", "x5c": [_cert_b64]}
+    headers = {"typ": "application/identifierlist+jwt", "x5c": [signer.x5c]}
 
-    signed_jwt = jwt.encode(payload, private_key, algorithm="ES256", headers=headers)
+    # Encoding and signing, which pyjwt doesn't expose separately
+    with metrics.timed("jwt_encode_seconds", list="identifier_list"):
+        signed_jwt = jwt.encode(
+            payload, signer.private_key, algorithm="ES256", headers=headers
+        )
 
     return signed_jwt
 
@@ -93,28 +73,10 @@ def identifier_list_cwt_format(
         str: The encoded CWT
     """
 
-    # private_key = ec.generate_private_key(ec.SECP256R1())
-
-    with open(cfgservice.countries[country]["privKey"], "rb") as key_file:
-        private_key = serialization.load_pem_private_key(
-            key_file.read(),
-            password=(
-                cfgservice.countries[country]["privkey_passwd"]
-                if cfgservice.countries[country]["privkey_passwd"] is not None
-                else None
-            ),
-            backend=default_backend(),
-        )
-
-    with open(cfgservice.countries[country]["cert"], "rb") as file:
-        certificate = file.read()
-
-    cert = x509.load_der_x509_certificate(certificate)
-
-    _cert = cert.public_bytes(getattr(serialization.Encoding, "DER"))
+    signer = get_signer(country)
 
     unprotected = {4: b"1"}
-    protected = {1: -7, 16: "application/identifierlist+cwt", 33: _cert}
+    protected = {1: -7, 16: "application/identifierlist+cwt", 33: signer.cert_der}
 
     claims = {
         1: cfgservice.service_url[:-1],
@@ -124,12 +86,14 @@ def identifier_list_cwt_format(
         65533: identifier_list,
     }
 
-    cbor_header = cbor2.dumps(protected)
-    cbor_claims = cbor2.dumps(claims)
+    with metrics.timed("cbor_encode_seconds", list="identifier_list"):
+        cbor_header = cbor2.dumps(protected)
+        cbor_claims = cbor2.dumps(claims)
 
     message = cbor_header + cbor_claims
 
-    signature = private_key.sign(message, ec.ECDSA(hashes.SHA256()))
+    with metrics.timed("ecdsa_sign_seconds", list="identifier_list"):
+        signature = signer.private_key.sign(message, ec.ECDSA(hashes.SHA256()))
 
     cose_sign1 = [cbor_header, unprotected, cbor_claims, signature]
     tagged = cbor2.CBORTag(18, cose_sign1)
@@ -0,0 +1,182 @@
+# coding: latin-1
+###############################################################################
+# Copyright (c) 2023 European Commission
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+###############################################################################
+import base64
+import sys
+import zlib
+from array import array
+from bisect import bisect_left
+
+
+def _to_bytes(values: array) -> bytes:
+    """Returns the content of an array in little endian byte order"""
+    if sys.byteorder == "big":
+        values = array(values.typecode, values)
+        values.byteswap()
+
+    return values.tobytes()
+
+
+def _from_bytes(typecode: str, value: bytes) -> array:
+    """Returns the array whose content was returned by _to_bytes"""
+    values = array(typecode)
+    values.frombytes(value)
+
+    if sys.byteorder == "big":
+        values.byteswap()
+
+    return values
+
+
+def _to_b64(values: array) -> str:
+    """Encodes an array as compressed base64url"""
+    return base64.urlsafe_b64encode(zlib.compress(_to_bytes(values))).decode()
+
+
+def _from_b64(typecode: str, value: str) -> array:
+    """Decodes an array encoded with _to_b64"""
+    return _from_bytes(typecode, zlib.decompress(base64.urlsafe_b64decode(value)))
+
+
+class IdentifierList:
+    """
+    Identifier list, holding the status of the ids that are not valid.
+
+    Ids are kept in a sorted array, with their statuses in a parallel array, instead
+    of a dict of strings. Ids not in the list have status 0.
+    """
+
+    def __init__(self, ids: array = None, statuses: array = None):
+        self.ids = ids if ids is not None else array("I")
+        self.statuses = statuses if statuses is not None else array("B")
+
+    def get(self, id: int) -> int:
+        """
+        Returns the status of an id
+
+        Args:
+            id (int): the id
+
+        Returns:
+            int: the status, 0 if the id isn't in the list
+        """
+
+        position = bisect_left(self.ids, id)
+
+        if position < len(self.ids) and self.ids[position] == id:
+            return self.statuses[position]
+
+        return 0
+
+    def set(self, id: int, status: int):
+        """
+        Sets the status of an id. Setting status 0 removes the id from the list.
+
+        Args:
+            id (int): the id
+            status (int): the new status
+        """
+
+        position = bisect_left(self.ids, id)
+        present = position < len(self.ids) and self.ids[position] == id
+
+        if status == 0:
+            if present:
+                del self.ids[position]
+                del self.statuses[position]
+        elif present:
+            self.statuses[position] = status
+        else:
+            self.ids.insert(position, id)
+            self.statuses.insert(position, status)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, id: int):
+        return self.get(id) != 0
+
+    def to_dict(self) -> dict:
+        """
+        Returns the list in the shape used in the signed JWT and CWT payloads
+
+        Returns:
+            dict: statuses by id, with ids as strings
+        """
+
+        return {str(id): status for id, status in zip(self.ids, self.statuses)}
+
+    def dump(self) -> dict:
+        """
+        Returns the json serializable representation of the list
+
+        Returns:
+            dict: the compressed ids and statuses
+        """
+
+        return {"ids": _to_b64(self.ids), "statuses": _to_b64(self.statuses)}
+
+    def to_bytes(self) -> tuple:
+        """
+        Returns the raw content of the list, as stored in the binary list state
+
+        Returns:
+            tuple: the ids (little endian uint32) and the statuses (uint8)
+        """
+
+        return _to_bytes(self.ids), _to_bytes(self.statuses)
+
+    @classmethod
+    def from_bytes(cls, ids: bytes, statuses: bytes) -> "IdentifierList":
+        """
+        Parses a list from the output of to_bytes
+
+        Args:
+            ids (bytes): the raw ids
+            statuses (bytes): the raw statuses
+
+        Returns:
+            IdentifierList: the parsed list
+        """
+
+        return cls(_from_bytes("I", ids), _from_bytes("B", statuses))
+
+    @classmethod
+    def load(cls, value: dict) -> "IdentifierList":
+        """
+        Parses a list from the output of dump, or from the dict of statuses by id
+        saved by previous versions
+
+        Args:
+            value (dict): the serialized list
+
+        Returns:
+            IdentifierList: the parsed list
+        """
+
+        if "ids" in value and "statuses" in value:
+            return cls(_from_b64("I", value["ids"]), _from_b64("B", value["statuses"]))
+
+        identifier_list = cls()
+        for id, status in sorted(
+            (int(id), int(status)) for id, status in value.items()
+        ):
+            if status != 0:
+                identifier_list.ids.append(id)
+                identifier_list.statuses.append(status)
+
+        return identifier_list
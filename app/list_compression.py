@@ -0,0 +1,159 @@
+# coding: latin-1
+###############################################################################
+# Copyright (c) 2023 European Commission
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+###############################################################################
+"""
+Incremental compression of large status list bitstrings.
+
+The bitstring is split into fixed size blocks, each deflated on its own and ended
+by a full flush, which aligns it on a byte boundary. The blocks are stitched into
+a single zlib stream, as produced by zlib.compress, with the adler32 checksum of
+the whole bitstring combined from the checksums of the blocks. After a change,
+only the blocks that differ are compressed again.
+"""
+import hashlib
+import zlib
+
+# zlib header of a deflate stream with a 32K window and maximum compression, the
+# level used by the token status list library
+ZLIB_HEADER = b"\x78\xda"
+
+# Empty final block, fixed Huffman codes
+FINAL_BLOCK = b"\x03\x00"
+
+ADLER_BASE = 65521
+
+
+def adler32_combine(adler1: int, adler2: int, length2: int) -> int:
+    """
+    Returns the adler32 checksum of two concatenated pieces of data, as zlib's
+    adler32_combine
+
+    Args:
+        adler1 (int): checksum of the first piece
+        adler2 (int): checksum of the second piece
+        length2 (int): length of the second piece
+
+    Returns:
+        int: checksum of the concatenation
+    """
+
+    remainder = length2 % ADLER_BASE
+    sum1 = adler1 & 0xFFFF
+    sum2 = (remainder * sum1) % ADLER_BASE
+    sum1 += (adler2 & 0xFFFF) + ADLER_BASE - 1
+    sum2 += (adler1 >> 16) + (adler2 >> 16) + ADLER_BASE - remainder
+
+    if sum1 >= ADLER_BASE:
+        sum1 -= ADLER_BASE
+    if sum1 >= ADLER_BASE:
+        sum1 -= ADLER_BASE
+    if sum2 >= ADLER_BASE << 1:
+        sum2 -= ADLER_BASE << 1
+    if sum2 >= ADLER_BASE:
+        sum2 -= ADLER_BASE
+
+    return sum1 | (sum2 << 16)
+
+
+def _deflate_block(data) -> bytes:
+    """Deflates a block, without zlib header, ending on a byte boundary"""
+    compressor = zlib.compressobj(9, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush(zlib.Z_FULL_FLUSH)
+
+
+class CompressedBlocks:
+    """
+    Compressed blocks of a bitstring, with what is needed to detect the blocks that
+    changed and to stitch them into a zlib stream.
+
+    Attributes:
+        block_size (int): size of the blocks in bytes, the last one may be shorter
+        digests (list): hash of the content of each block
+        deflated (list): compressed content of each block
+        checksums (list): adler32 checksum of each block
+        lengths (list): size of each block
+    """
+
+    def __init__(self, block_size: int):
+        self.block_size = block_size
+        self.digests = []
+        self.deflated = []
+        self.checksums = []
+        self.lengths = []
+
+    def update(self, data) -> int:
+        """
+        Compresses the blocks whose content differs from the last update
+
+        Args:
+            data (bytes or bytearray): the bitstring
+
+        Returns:
+            int: number of blocks compressed
+        """
+
+        view = memoryview(data)
+        count = -(-len(view) // self.block_size)
+        compressed = 0
+
+        del self.digests[count:]
+        del self.deflated[count:]
+        del self.checksums[count:]
+        del self.lengths[count:]
+
+        for position in range(count):
+            block = view[position * self.block_size : (position + 1) * self.block_size]
+            digest = hashlib.blake2b(block, digest_size=16).digest()
+
+            if position < len(self.digests):
+                if self.digests[position] == digest:
+                    continue
+
+                self.digests[position] = digest
+                self.deflated[position] = _deflate_block(block)
+                self.checksums[position] = zlib.adler32(block)
+                self.lengths[position] = len(block)
+            else:
+                self.digests.append(digest)
+                self.deflated.append(_deflate_block(block))
+                self.checksums.append(zlib.adler32(block))
+                self.lengths.append(len(block))
+
+            compressed += 1
+
+        return compressed
+
+    def compressed(self) -> bytes:
+        """
+        Stitches the blocks into a single zlib stream
+
+        Returns:
+            bytes: the compressed bitstring, readable by zlib.decompress
+        """
+
+        checksum = 1
+        for block_checksum, length in zip(self.checksums, self.lengths):
+            checksum = adler32_combine(checksum, block_checksum, length)
+
+        return b"".join(
+            (
+                ZLIB_HEADER,
+                *self.deflated,
+                FINAL_BLOCK,
+                checksum.to_bytes(4, "big"),
+            )
+        )
@@ -0,0 +1,396 @@
+# coding: latin-1
+###############################################################################
+# Copyright (c) 2023 European Commission
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+###############################################################################
+"""
+Journal of the changes made to lists since their state was last saved.
+
+Taking indexes and changing statuses append one json line to the journal of the
+process, in status_list_dir/journal/<pid>-<segment>.log, instead of rewriting the
+state of the list. Changed lists are kept in memory until a checkpoint saves them
+and removes the journal segments they were recorded in. At startup, the journals
+left by processes that are no longer running are replayed on the saved states.
+
+Records are:
+
+    {"t": "take", "c": country, "d": doctype, "r": rand, "i": [indexes], "e": expires,
+     "n": sequence}
+    {"t": "set", "c": country, "d": doctype, "r": rand, "s": [[index, status], ...],
+     "n": sequence}
+
+The sequence is a timestamp in nanoseconds, increasing within a process, that orders
+the records of every process when they are replayed.
+"""
+import json
+import os
+import threading
+import time
+
+from token_status_list import RandomIndexAllocator
+
+from app import metrics
+from app.config_service import ConfService as cfgservice
+
+JOURNAL_DIR = "journal"
+
+# Lists changed since their state was saved, as (list, country, doctype, number of
+# the segment of their last change) by token status list directory
+unsaved_lists = {}
+
+# Indexes whose status changed since their list was saved, by token status list
+# directory
+changed_statuses = {}
+
+journal_lock = threading.Lock()
+
+# Segment of the journal currently appended to, and its number
+journal_file = None
+journal_segment = 0
+
+# Sequence of the last record of this process
+last_sequence = 0
+sequence_lock = threading.Lock()
+
+# Records appended so far, and the number of them known to be on disk. Held while
+# syncing, taken before journal_lock, so that concurrent appends share an fsync
+journal_written = 0
+journal_synced = 0
+sync_lock = threading.Lock()
+
+# Segments closed but not removed yet, as (number, path)
+closed_segments = []
+
+
+def journal_directory() -> str:
+    """
+    Returns the directory of the journals
+
+    Returns:
+        str: path of the directory
+    """
+
+    return os.path.join(cfgservice.status_list_dir, JOURNAL_DIR)
+
+
+def _open_segment():
+    """Starts a new segment of the journal of this process, holding journal_lock"""
+    global journal_file, journal_segment
+
+    journal_segment += 1
+    os.makedirs(journal_directory(), exist_ok=True)
+
+    journal_file = open(
+        os.path.join(journal_directory(), f"{os.getpid()}-{journal_segment}.log"), "a"
+    )
+
+
+def append(record: dict, directory: str, specific_status_list, country, doctype):
+    """
+    Records a change made to a list in memory, and keeps the list until it is saved
+
+    Args:
+        record (dict): the change
+        directory (str): token status list directory of the list
+        specific_status_list (dict): the changed list
+        country (str): country code
+        doctype (str): doctype of the attestation
+    """
+
+    global journal_written, last_sequence
+
+    with sequence_lock:
+        last_sequence = max(last_sequence + 1, time.time_ns())
+        record["n"] = last_sequence
+
+    with metrics.timed("json_seconds", operation="dumps"):
+        line = json.dumps(record, separators=(",", ":")) + "\n"
+
+    with journal_lock:
+        if journal_file is None:
+            _open_segment()
+
+        with metrics.timed("journal_append_seconds"):
+            journal_file.write(line)
+            journal_file.flush()
+
+        journal_written += 1
+        position = journal_written
+
+        # Registered under the same lock as the append, so that a segment is only
+        # removed once every list changed in it is saved
+        unsaved_lists[directory] = (
+            specific_status_list,
+            country,
+            doctype,
+            journal_segment,
+        )
+
+        if record["t"] == "set":
+            changed_statuses.setdefault(directory, set()).update(
+                index for index, _ in record["s"]
+            )
+
+    if cfgservice.journal_fsync:
+        _sync(position)
+
+
+def _sync(position: int):
+    """
+    Waits until the record appended at a position is on disk. A single fsync covers
+    every record appended before it, so concurrent requests wait for the same one.
+
+    Args:
+        position (int): value of journal_written after the record was appended
+    """
+
+    global journal_synced
+
+    with sync_lock:
+        if journal_synced >= position:
+            return
+
+        with journal_lock:
+            if journal_file is None:
+                # Closed by rotate, after syncing it
+                return
+            target = journal_written
+            descriptor = journal_file.fileno()
+
+        with metrics.timed("journal_fsync_seconds"):
+            os.fsync(descriptor)
+
+        journal_synced = target
+
+
+def unsaved_list(directory: str) -> dict:
+    """
+    Returns a list changed since its state was saved
+
+    Args:
+        directory (str): token status list directory of the list
+
+    Returns:
+        dict: the list in memory, None if its saved state is up to date
+    """
+
+    entry = unsaved_lists.get(directory)
+
+    return entry[0] if entry is not None else None
+
+
+def changed_indexes(directory: str) -> set:
+    """
+    Returns the indexes of a list whose status changed since it was saved
+
+    Args:
+        directory (str): token status list directory of the list
+
+    Returns:
+        set: the indexes
+    """
+
+    with journal_lock:
+        return set(changed_statuses.get(directory, ()))
+
+
+def rotate() -> tuple:
+    """
+    Closes the current segment, so that it can be removed once the lists changed
+    are saved
+
+    Returns:
+        tuple: number of the last segment closed, and the lists to save, as
+        (directory, list, country, doctype)
+    """
+
+    global journal_file, journal_synced
+
+    with sync_lock, journal_lock:
+        if journal_file is not None:
+            if cfgservice.journal_fsync:
+                os.fsync(journal_file.fileno())
+                journal_synced = journal_written
+
+            closed_segments.append((journal_segment, journal_file.name))
+            journal_file.close()
+            journal_file = None
+
+        return journal_segment, [
+            (directory, specific_status_list, country, doctype)
+            for directory, (
+                specific_status_list,
+                country,
+                doctype,
+                _,
+            ) in unsaved_lists.items()
+        ]
+
+
+def mark_saved(directory: str, segment: int):
+    """
+    Forgets a list whose state was saved, unless it changed again in a later segment.
+    Must be called holding the lock of the list, so every status changed is saved.
+
+    Args:
+        directory (str): token status list directory of the list
+        segment (int): last segment closed before the list was saved
+    """
+
+    with journal_lock:
+        changed_statuses.pop(directory, None)
+
+        entry = unsaved_lists.get(directory)
+        if entry is not None and entry[3] <= segment:
+            del unsaved_lists[directory]
+
+
+def remove_saved_segments() -> int:
+    """
+    Removes the closed segments whose changes are all saved
+
+    Returns:
+        int: number of segments removed
+    """
+
+    with journal_lock:
+        oldest_unsaved = min(
+            (entry[3] for entry in unsaved_lists.values()), default=journal_segment + 1
+        )
+        removable = [
+            path for number, path in closed_segments if number < oldest_unsaved
+        ]
+        closed_segments[:] = [
+            (number, path)
+            for number, path in closed_segments
+            if number >= oldest_unsaved
+        ]
+
+    for path in removable:
+        os.remove(path)
+
+    return len(removable)
+
+
+def keep_records(records: list):
+    """
+    Writes records that failed to be replayed to segment 0 of this process, never
+    used by its journal, so that they are replayed again once it stops
+
+    Args:
+        records (list): the records
+    """
+
+    path = os.path.join(journal_directory(), f"{os.getpid()}-0.log")
+
+    with open(path, "a") as f:
+        for record in records:
+            f.write(json.dumps(record, separators=(",", ":")) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def _process_running(pid: int) -> bool:
+    """Tells whether a process exists"""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+
+    return True
+
+
+def orphan_segments() -> list:
+    """
+    Returns the journal segments of the processes no longer running
+
+    Returns:
+        list: paths of the segments, in the order they were written per process.
+        Records of different processes are ordered by their sequence.
+    """
+
+    try:
+        names = os.listdir(journal_directory())
+    except FileNotFoundError:
+        return []
+
+    segments = []
+
+    for name in names:
+        try:
+            pid, segment = (int(part) for part in name[: -len(".log")].split("-"))
+        except ValueError:
+            continue
+
+        if pid == os.getpid() or not _process_running(pid):
+            segments.append((pid, segment, os.path.join(journal_directory(), name)))
+
+    return [path for _, _, path in sorted(segments)]
+
+
+def read_records(path: str):
+    """
+    Reads the records of a segment, up to the first incomplete one
+
+    Args:
+        path (str): path of the segment
+
+    Yields:
+        dict: the records
+    """
+
+    with open(path, "r") as f:
+        for line in f:
+            try:
+                yield json.loads(line)
+            except ValueError:
+                # Last record of a process stopped while appending it
+                return
+
+
+def apply_record(specific_status_list: dict, record: dict):
+    """
+    Applies a journal record to a list read from its saved state. Applying a record
+    already included in the state is harmless only when the records are applied in
+    the order of their sequence: a status changed by a later record would otherwise
+    be reverted.
+
+    Args:
+        specific_status_list (dict): the list
+        record (dict): the record
+    """
+
+    token_status_list = specific_status_list["token_status_list"]
+
+    if record["t"] == "take":
+        allocator = token_status_list.allocator
+
+        for index in record["i"]:
+            if isinstance(allocator, RandomIndexAllocator):
+                if allocator.allocated[index] == 0:
+                    allocator.allocated[index] = 1
+                    allocator.num_allocated += 1
+            else:
+                allocator.next = max(allocator.next, index + 1)
+
+        specific_status_list["expires"] = record["e"]
+
+    elif record["t"] == "set":
+        for index, status in record["s"]:
+            # Later records may have made the index invalid already
+            token_status_list.status_list.set(index, status)
+            specific_status_list["identifier_list"].set(index, status)
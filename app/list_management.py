@@ -15,11 +15,18 @@
 # limitations under the License.
 #
 ###############################################################################
-import copy
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
 from datetime import datetime
+import atexit
+import fcntl
+import hashlib
 import json
 import os
+import shutil
 import sys
+import threading
+import time
 from urllib.parse import urlparse
 from uuid import uuid4
 
@@ -29,135 +36,861 @@ from app.config_service import ConfService as cfgservice
 # current_dir = os.path.dirname(os.path.abspath(__file__))
 # sys.path.append(os.path.join(current_dir, '..', 'token-status-list-py'))
 
-from token_status_list import IssuerStatusList, NoMoreIndices
+from token_status_list import IssuerStatusList, NoMoreIndices, RandomIndexAllocator
 
-from app.status_list_format import cwt_format, jwt_format
+from app import list_journal, metrics
+from app.artifact_cache import invalidate_artifacts
+from app.identifier_list_store import IdentifierList
+from app.list_compression import CompressedBlocks
+from app.list_storage import (
+    SIGNATURE_FILE,
+    expiry_timestamp,
+    header_fill_ratio,
+    identifier_list_directory,
+    list_content_hash,
+    migrate_list,
+    read_list_header,
+    read_list_state,
+    read_signature,
+    state_file,
+    write_file,
+    write_list_state,
+)
+from app.status_list_format import (
+    compress_status_list,
+    cwt_compressed_list,
+    cwt_format,
+    jwt_format,
+)
 from app.identifier_list_format import (
     identifier_list_cwt_format,
     identifier_list_jwt_format,
 )
 
-status_list = {}
+# Lists currently used to take indexes, by country and doctype
+status_list = {}
+
+# Lists created and signed ahead of time, used when the current list is full
+next_lists = {}
+
+# (country, doctype) pairs whose next list is being prepared
+preparing_lists = set()
+
+# Scans of the lists left on disk by previous runs, by country
+rehydration_scans = {}
+
+# Parsed lists read by get_list, by state directory
+list_cache = OrderedDict()
+
+list_cache_lock = threading.Lock()
+
+# Compressed token status lists, by state directory, as (content hash, bitstring,
+# CompressedBlocks of the lists compressed by blocks)
+compressed_lists = OrderedDict()
+
+compressed_lists_lock = threading.Lock()
+
+
+def _reset_compressed_lists_lock():
+    """Renewal worker processes are forked while the lock may be held"""
+    global compressed_lists_lock
+    compressed_lists_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_compressed_lists_lock)
+
+# Locks of each (country, doctype) list, held while the list is read or changed
+list_locks = {}
+
+# Held only briefly, to create lists and their locks
+lists_lock = threading.Lock()
+
+
+def get_list_lock(country, doctype):
+    """
+    Returns the lock protecting the lists of a country and doctype
+
+    Args:
+        country (str): country code
+        doctype (str): doctype of the attestation
+
+    Returns:
+        threading.RLock: The lock
+    """
+
+    lock = list_locks.get((country, doctype))
+
+    if lock is None:
+        with lists_lock:
+            lock = list_locks.setdefault((country, doctype), threading.RLock())
+
+    return lock
+
+
+OWNER_LOCK_FILE = "owner.lock"
+
+# Open owner lock files of the lists claimed by this process, by token status list
+# directory
+owned_lists = {}
+
+owned_lists_lock = threading.Lock()
+
+
+def _release_inherited_lists():
+    """Claims belong to the process that took them, not to forked renewal workers"""
+    global owned_lists_lock
+    owned_lists_lock = threading.Lock()
+
+    for lock_file in owned_lists.values():
+        lock_file.close()
+    owned_lists.clear()
+
+
+os.register_at_fork(after_in_child=_release_inherited_lists)
+
+
+def claim_list(directory) -> bool:
+    """
+    Claims a list for this process, by holding an exclusive lock on its owner.lock
+    until the process exits or releases it. Only the owner of a list takes indexes
+    from it, so that processes sharing status_list_dir never hand out the same index.
+
+    Args:
+        directory (str): token status list directory of the list
+
+    Returns:
+        bool: whether this process owns the list
+    """
+
+    with owned_lists_lock:
+        if directory in owned_lists:
+            return True
+
+        os.makedirs(directory, exist_ok=True)
+        lock_file = open(os.path.join(directory, OWNER_LOCK_FILE), "a")
+
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock_file.close()
+            return False
+
+        owned_lists[directory] = lock_file
+
+    return True
+
+
+def release_list(directory):
+    """
+    Releases a list claimed by this process, which no longer takes indexes from it
+
+    Args:
+        directory (str): token status list directory of the list
+    """
+
+    with owned_lists_lock:
+        lock_file = owned_lists.pop(directory, None)
+
+    if lock_file is not None:
+        lock_file.close()
+
+
+STATE_LOCK_FILE = "state.lock"
+
+REPLAY_LOCK_FILE = "replay.lock"
+
+# State file of each list as last saved by this process, as (inode, mtime, size)
+saved_states = {}
+
+
+def _file_state(path: str) -> tuple:
+    """Returns the values used to detect a change of a file on disk"""
+    stat = os.stat(path)
+    return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+
+def list_bits(doctype: str) -> int:
+    """
+    Returns the number of bits per status of the new lists of a doctype
+
+    Args:
+        doctype (str): doctype of the attestation
+
+    Returns:
+        int: 1, 2, 4 or 8
+    """
+
+    return cfgservice.status_list_bits.get(doctype, 1)
+
+
+def list_size(country: str, doctype: str, previous: dict = None) -> int:
+    """
+    Returns the number of statuses of a new list. In adaptive mode, the size follows
+    the issuance rate of the list it replaces, so that it lasts about
+    adaptive_list_lifetime.
+
+    Args:
+        country (str): country code
+        doctype (str): doctype of the attestation
+        previous (dict): list replaced by the new one, if any
+
+    Returns:
+        int: the size, a multiple of 8
+    """
+
+    sizes = cfgservice.token_status_list_sizes
+    size = sizes.get((country, doctype), sizes.get(doctype))
+
+    if size is None:
+        size = cfgservice.token_status_list_size
+
+    # Lists saved by previous versions have no creation time
+    if cfgservice.adaptive_list_size and previous and "created" in previous:
+        allocator = previous["token_status_list"].allocator
+        taken = (
+            allocator.num_allocated
+            if isinstance(allocator, RandomIndexAllocator)
+            else allocator.next
+        )
+        elapsed = max(time.time() - previous["created"], 1)
+
+        size = min(
+            max(
+                int(taken / elapsed * cfgservice.adaptive_list_lifetime),
+                cfgservice.min_list_size,
+            ),
+            cfgservice.max_list_size,
+        )
+
+        cfgservice.app_logger.info(
+            f"Next list of {country}/{doctype} sized {size} for {taken} indexes "
+            f"taken in {int(elapsed)}s"
+        )
+
+    # Status lists and allocators are both allocated in whole bytes
+    return -(-size // 8) * 8
+
+
+def new_list(
+    country: str, doctype: str, expiry_date=None, register=True, previous=None
+):
+    """
+    Initializes a new status list which inclues both the token status list and identifier status list, separated by country and doctype.
+
+    Args:
+        country (str): country code
+        doctype (str): doctype of the attestation
+        expiry_date (str): expiry date of the first attestation
+        register (bool): whether the new list replaces the current list of the same country and doctype
+        previous (dict): list replaced by the new one, used to size it
+
+    Returns:
+        dict: The new list
+    """
+
+    specific_status_list = {
+        "token_status_list": IssuerStatusList.new(
+            list_bits(doctype), list_size(country, doctype, previous), "random"
+        ),
+        "identifier_list": IdentifierList(),
+        "expires": expiry_date,
+        "rand": str(uuid4()),
+        "created": int(time.time()),
+    }
+
+    claim_list(
+        list_directory(
+            "token_status_list", country, doctype, specific_status_list["rand"]
+        )
+    )
+
+    if register:
+        with lists_lock:
+            status_list.setdefault(country, {})[doctype] = specific_status_list
+
+    metrics.increment("lists_created_total", country=country, doctype=doctype)
+
+    return specific_status_list
+
+
+def list_fill_ratio(specific_status_list):
+    """
+    Returns the fraction of the indexes of a list already taken
+
+    Args:
+        specific_status_list (dict): status list
+
+    Returns:
+        float: ratio between 0 and 1
+    """
+
+    allocator = specific_status_list["token_status_list"].allocator
+
+    if isinstance(allocator, RandomIndexAllocator):
+        return allocator.num_allocated / allocator.allocated.size
+
+    return allocator.next / allocator.size
+
+
+def collect_list_metrics():
+    """
+    Returns the fill ratio of the current lists, collected when metrics are rendered
+
+    Returns:
+        list: (name, labels, value) samples
+    """
+
+    with lists_lock:
+        current = [
+            (country, doctype, specific_status_list)
+            for country, lists in status_list.items()
+            for doctype, specific_status_list in lists.items()
+        ]
+        prepared = len(next_lists)
+
+    samples = [
+        (
+            "list_fill_ratio",
+            {"country": country, "doctype": doctype},
+            list_fill_ratio(specific_status_list),
+        )
+        for country, doctype, specific_status_list in current
+    ]
+    samples.append(("current_lists", {}, len(current)))
+    samples.append(("prepared_lists", {}, prepared))
+
+    return samples
+
+
+metrics.register_collector(collect_list_metrics)
+metrics.describe(
+    "list_fill_ratio", "Fraction of the indexes taken in the current lists"
+)
+metrics.describe("indexes_taken_total", "Indexes taken, by country and doctype")
+
+
+def prepare_next_list(country, doctype, expiry_date, previous=None):
+    """
+    Creates and signs the list that replaces the current one when it is full
+
+    Args:
+        country (str): country code
+        doctype (str): doctype of the attestation
+        expiry_date (str): expiry date of the current list
+        previous (dict): current list
+    """
+
+    try:
+        specific_status_list = new_list(
+            country, doctype, expiry_date, register=False, previous=previous
+        )
+        dump_list(specific_status_list, country, doctype)
+
+        with lists_lock:
+            next_lists[(country, doctype)] = specific_status_list
+    except Exception:
+        cfgservice.app_logger.error(
+            f"Failed to prepare the next list of {country}/{doctype}", exc_info=True
+        )
+    finally:
+        with lists_lock:
+            preparing_lists.discard((country, doctype))
+
+
+def prepare_next_list_if_needed(specific_status_list, country, doctype):
+    """
+    Starts preparing the next list in background once the current one is almost full
+
+    Args:
+        specific_status_list (dict): current list
+        country (str): country code
+        doctype (str): doctype of the attestation
+    """
+
+    if list_fill_ratio(specific_status_list) < cfgservice.next_list_threshold:
+        return
+
+    with lists_lock:
+        if (country, doctype) in next_lists or (country, doctype) in preparing_lists:
+            return
+        preparing_lists.add((country, doctype))
+
+    task_thread = threading.Thread(
+        target=prepare_next_list,
+        args=(country, doctype, specific_status_list["expires"], specific_status_list),
+        daemon=True,
+    )
+    task_thread.start()
+
+
+def list_directory(list_type, country, doctype, rand):
+    """
+    Returns the directory where a list is stored
+
+    Args:
+        list_type (str): token_status_list or identifier_list
+        country (str): country code
+        doctype (str): doctype of the attestation
+        rand (str): random identifier of the list
+
+    Returns:
+        str: path of the directory
+    """
+
+    return f"{cfgservice.status_list_dir}/{list_type}/{country}/{doctype}/{rand}"
+
+
+def merge_saved_state(specific_status_list, directory, changed):
+    """
+    Merges into a list in memory the changes saved by other processes since this one
+    read or saved it: the indexes they took, the statuses they changed and the later
+    expiry. Statuses changed in memory since the last save are kept, unless the saved
+    one is invalid, which is final.
+
+    Args:
+        specific_status_list (dict): status list in memory
+        directory (str): token status list directory of the list
+        changed (set): indexes whose status changed in memory since the last save
+    """
+
+    saved = read_list_state(directory)
+    token_status_list = specific_status_list["token_status_list"]
+    saved_token_status_list = saved["token_status_list"]
+
+    allocator = token_status_list.allocator
+    saved_allocator = saved_token_status_list.allocator
+
+    if isinstance(allocator, RandomIndexAllocator):
+        allocated = allocator.allocated.lst
+        merged = int.from_bytes(allocated, "big") | int.from_bytes(
+            saved_allocator.allocated.lst, "big"
+        )
+        allocated[:] = merged.to_bytes(len(allocated), "big")
+        allocator.num_allocated = merged.bit_count()
+    else:
+        allocator.next = max(allocator.next, saved_allocator.next)
+
+    statuses = saved_token_status_list.status_list
+    identifier_list = saved["identifier_list"]
+
+    for index in changed:
+        if statuses.get(index) != 1:
+            status = token_status_list.status_list.get(index)
+            statuses.set(index, status)
+            identifier_list.set(index, status)
+
+    # Lists in memory are only changed in place, the renewal publishes the statuses
+    # changed by others as the content no longer matches the signature
+    token_status_list.status_list.lst[:] = statuses.lst
+    specific_status_list["identifier_list"] = identifier_list
+
+    if saved["expires"] is not None and (
+        specific_status_list["expires"] is None
+        or saved["expires"] > specific_status_list["expires"]
+    ):
+        specific_status_list["expires"] = saved["expires"]
+
+
+def save_list_state(specific_status_list, country, doctype, changed=None):
+    """
+    Writes the full state of a list (allocator, statuses, identifier list and expiry)
+    to disk, without signing it. A state saved meanwhile by another process, which
+    changed statuses of the list or resumed it after this one released it, is merged
+    first instead of being overwritten.
+
+    Args:
+        specific_status_list (dict): status list to save
+        country (str): country code
+        doctype (str): doctype of the attestation
+        changed (set): indexes whose status changed since the list was read, by
+            default those recorded in the journal
+    """
+
+    directory = list_directory(
+        "token_status_list", country, doctype, specific_status_list["rand"]
+    )
+    os.makedirs(directory, exist_ok=True)
+
+    with open(os.path.join(directory, STATE_LOCK_FILE), "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+
+        try:
+            current_state = _file_state(state_file(directory))
+        except FileNotFoundError:
+            current_state = None
+
+        if current_state is not None and current_state != saved_states.get(directory):
+            if changed is None:
+                changed = list_journal.changed_indexes(directory)
+
+            merge_saved_state(specific_status_list, directory, changed)
+
+        write_list_state(directory, specific_status_list, country, doctype)
+        saved_states[directory] = _file_state(state_file(directory))
+
+    invalidate_cached_list(directory)
+
+
+def checkpoint_lists() -> int:
+    """
+    Saves the state of the lists changed since the last checkpoint, and removes the
+    journal segments no longer needed
+
+    Returns:
+        int: number of lists saved
+    """
+
+    segment, lists = list_journal.rotate()
+    saved = 0
+
+    for directory, specific_status_list, country, doctype in lists:
+        try:
+            with get_list_lock(country, doctype):
+                save_list_state(specific_status_list, country, doctype)
+                list_journal.mark_saved(directory, segment)
+            saved += 1
+        except Exception:
+            cfgservice.app_logger.error(
+                f"Failed to save the list {directory}", exc_info=True
+            )
+
+    list_journal.remove_saved_segments()
+
+    return saved
+
+
+def replay_journal() -> int:
+    """
+    Applies to the saved list states the journals of the processes that stopped
+    before saving them, in the order the records were written across processes.
+    Lists owned by a running process, which took their indexes, only get the status
+    changes, merged into their saved state as the owner does on its next save.
+    Processes starting together replay one after the other, holding a lock on
+    journal/replay.lock, the later ones finding the segments already replayed.
+
+    Returns:
+        int: number of records replayed
+    """
+
+    os.makedirs(list_journal.journal_directory(), exist_ok=True)
+
+    with open(
+        os.path.join(list_journal.journal_directory(), REPLAY_LOCK_FILE), "a"
+    ) as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        return _replay_segments(list_journal.orphan_segments())
+
+
+def _replay_segments(segments: list) -> int:
+    """Replays journal segments, holding the replay lock"""
+    records = {}
+    replayed = 0
+    failed = []
+
+    for path in segments:
+        try:
+            for record in list_journal.read_records(path):
+                directory = list_directory(
+                    "token_status_list", record["c"], record["d"], record["r"]
+                )
+                records.setdefault(directory, []).append(record)
+        except FileNotFoundError:
+            # Replayed meanwhile by a process that didn't hold the lock yet
+            continue
+
+    for directory, list_records in records.items():
+        # Removed since, as expired
+        if not os.path.exists(state_file(directory)):
+            continue
+
+        claimed = claim_list(directory)
+
+        try:
+            if not claimed:
+                list_records = [
+                    record for record in list_records if record["t"] == "set"
+                ]
+
+            # Records without sequence, written by previous versions, keep the order
+            # of their segments
+            list_records.sort(key=lambda record: record.get("n", 0))
+
+            temp_list = read_list_state(directory)
+            changed = set()
+
+            for record in list_records:
+                list_journal.apply_record(temp_list, record)
+                if record["t"] == "set":
+                    changed.update(index for index, _ in record["s"])
+
+            save_list_state(
+                temp_list, temp_list["country"], temp_list["doctype"], changed
+            )
+            replayed += len(list_records)
+        except Exception:
+            cfgservice.app_logger.error(
+                f"Failed to replay the journal of the list {directory}", exc_info=True
+            )
+            failed.extend(list_records)
+        finally:
+            # Resumed later by whichever process finds it first
+            if claimed:
+                release_list(directory)
+
+    for path in segments:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    # The records of the lists that failed are kept, the others are not replayed
+    # again over later changes
+    if failed:
+        list_journal.keep_records(failed)
+
+    if segments:
+        cfgservice.app_logger.info(
+            f"Replayed {replayed} journal records on {len(records)} lists, "
+            f"kept {len(failed)} that failed"
+        )
+
+    return replayed
+
+
+def checkpoint_periodically():
+    while True:
+        time.sleep(cfgservice.journal_checkpoint_interval)
+        checkpoint_lists()
+
+
+def start_checkpoint_thread():
+    atexit.register(checkpoint_lists)
+
+    task_thread = threading.Thread(target=checkpoint_periodically, daemon=True)
+    task_thread.start()
+
+
+def compressed_hash(compressed: bytes) -> str:
+    """
+    Returns the hash of a compressed bitstring, recorded in the signature of the list
+    published with it
+
+    Args:
+        compressed (bytes): the zlib compressed bitstring
+
+    Returns:
+        str: hex encoded sha256
+    """
+
+    return hashlib.sha256(compressed).hexdigest()
+
+
+def compressed_status_list(specific_status_list, directory, version) -> bytes:
+    """
+    Returns the compressed bitstring of a token status list, compressing it only
+    when its content changed since it was last compressed or published. Lists
+    larger than compression_block_size are compressed by blocks, only the blocks
+    changed since the last compression are compressed again.
+
+    Args:
+        specific_status_list (dict): status list
+        directory (str): token status list directory of the list
+        version (str): content hash of the list
+
+    Returns:
+        bytes: the zlib compressed bitstring
+    """
+
+    with compressed_lists_lock:
+        cached = compressed_lists.get(directory)
+        if cached is not None and cached[0] == version:
+            compressed_lists.move_to_end(directory)
+            metrics.increment("compressed_lists_total", result="cached")
+            return cached[1]
+
+        # The blocks are updated in place, a list signed concurrently compresses
+        # its own
+        blocks = None
+        if cached is not None:
+            blocks = cached[2]
+            compressed_lists[directory] = (cached[0], cached[1], None)
+
+    compressed = None
+
+    # After a restart, or in renewal worker processes, the published CWT holds
+    # the bitstring of unchanged lists. Publications of different processes may
+    # interleave, the CWT is only reused when it holds the bitstring recorded in
+    # the signature.
+    signature = read_signature(directory)
+    if (
+        signature is not None
+        and signature.get("content_hash") == version
+        and "compressed_hash" in signature
+    ):
+        try:
+            with open(os.path.join(directory, "token_status_list.cwt"), "rb") as f:
+                published = cwt_compressed_list(f.read())
+
+            if compressed_hash(published) == signature["compressed_hash"]:
+                compressed = published
+                metrics.increment("compressed_lists_total", result="published")
+        except (OSError, ValueError, LookupError):
+            cfgservice.app_logger.warning(
+                f"Unable to read the published list {directory}", exc_info=True
+            )
+
+    bitstring = specific_status_list["token_status_list"].status_list.lst
+    block_size = cfgservice.compression_block_size
+
+    if compressed is None and len(bitstring) > block_size:
+        if blocks is None or blocks.block_size != block_size:
+            blocks = CompressedBlocks(block_size)
+
+        with metrics.timed("compression_seconds"):
+            metrics.increment("compressed_blocks_total", blocks.update(bitstring))
+            compressed = blocks.compressed()
+        metrics.increment("compressed_lists_total", result="blocks")
+    elif compressed is None:
+        compressed = compress_status_list(specific_status_list["token_status_list"])
+        metrics.increment("compressed_lists_total", result="compressed")
+
+    with compressed_lists_lock:
+        compressed_lists[directory] = (version, compressed, blocks)
+        compressed_lists.move_to_end(directory)
+        while len(compressed_lists) > cfgservice.compressed_list_cache_size:
+            compressed_lists.popitem(last=False)
+
+    return compressed
+
+
+def sign_list(specific_status_list, country, doctype) -> dict:
+    """
+    Signs the token status list and the identifier list, without writing them
+
+    Args:
+        specific_status_list (dict): status list to sign
+        country (str): country code
+        doctype (str): doctype of the attestation
+
+    Returns:
+        dict: content of the JWT and CWT artifacts, by path
+    """
+
+    rand = specific_status_list["rand"]
+    status_list_uri = (
+        cfgservice.service_url + f"token_status_list/{country}/{doctype}/{rand}"
+    )
+    identifier_list_uri = (
+        cfgservice.service_url + f"identifier_list/{country}/{doctype}/{rand}"
+    )
+
+    directory = list_directory("token_status_list", country, doctype, rand)
+    identifier_list_directory = list_directory(
+        "identifier_list", country, doctype, rand
+    )
+
+    token_status_list = specific_status_list["token_status_list"]
+    identifier_list = specific_status_list["identifier_list"].to_dict()
+
+    specific_status_list.update(
+        {
+            "status_list_uri": status_list_uri,
+            "identifier_list_uri": identifier_list_uri,
+        }
+    )
+
+    signature = {
+        "signed_at": int(time.time()),
+        "content_hash": list_content_hash(specific_status_list),
+    }
+
+    # Compressed once for both formats
+    compressed = compressed_status_list(
+        specific_status_list, directory, signature["content_hash"]
+    )
+    signature["compressed_hash"] = compressed_hash(compressed)
 
-identifier_list = {}
+    # The signature is written last, a list interrupted while being written is
+    # renewed again
+    return {
+        os.path.join(directory, "token_status_list.jwt"): jwt_format(
+            token_status_list, country, status_list_uri, compressed
+        ),
+        os.path.join(directory, "token_status_list.cwt"): cwt_format(
+            token_status_list, country, status_list_uri, compressed
+        ),
+        os.path.join(
+            identifier_list_directory, "identifier_list.jwt"
+        ): identifier_list_jwt_format(identifier_list, country, identifier_list_uri),
+        os.path.join(
+            identifier_list_directory, "identifier_list.cwt"
+        ): identifier_list_cwt_format(identifier_list, country, identifier_list_uri),
+        os.path.join(directory, SIGNATURE_FILE): json.dumps(signature),
+    }
 
 
-def new_list(country: str, doctype: str):
+def write_artifacts(artifacts: dict):
     """
-    Initializes a new status list which inclues both the token status list and identifier status list, separated by country and doctype.
+    Writes signed artifacts to disk
 
     Args:
-        country (str): country code
-        doctype (str): doctype of the attestation
+        artifacts (dict): content of the artifacts, by path
     """
 
-    status_list.update(
-        {
-            country: {
-                doctype: {
-                    "token_status_list": IssuerStatusList.new(
-                        1, cfgservice.token_status_list_size, "random"
-                    ),
-                    "identifier_list": identifier_list,
-                    "expires": None,
-                    "rand": str(uuid4()),
-                }
-            }
-        }
-    )
+    for path, content in artifacts.items():
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        write_file(path, content)
 
+    invalidate_artifacts(artifacts)
 
-def dump_list(specific_status_list, country, doctype):
+
+def publish_list(specific_status_list, country, doctype):
     """
-    Dumps the status lists to disk.
+    Signs the token status list and the identifier list and writes the JWT and CWT
+    artifacts to disk.
 
     Args:
-        specific_status_list (dict): status list to dump
+        specific_status_list (dict): status list to publish
         country (str): country code
         doctype (str): doctype of the attestation
     """
 
-    rand = specific_status_list["rand"]
-    directory = (
-        f"{cfgservice.status_list_dir}/token_status_list/{country}/{doctype}/{rand}"
-    )
-    os.makedirs(directory, exist_ok=True)
+    with metrics.timed("publish_seconds"):
+        write_artifacts(sign_list(specific_status_list, country, doctype))
 
-    json_file_path = os.path.join(directory, "full_list.json")
 
-    dict_copy = copy.deepcopy(specific_status_list)
-    dict_copy["token_status_list"] = dict_copy["token_status_list"].dump()
-    dict_copy["country"] = country
-    dict_copy["doctype"] = doctype
+def dump_list(specific_status_list, country, doctype):
+    """
+    Dumps the status lists to disk, signing them and saving their state.
 
-    with open(json_file_path, "w") as f:
-        f.write(json.dumps(dict_copy))
+    Args:
+        specific_status_list (dict): status list to dump
+        country (str): country code
+        doctype (str): doctype of the attestation
+    """
 
-    jwt_file_path = os.path.join(directory, "token_status_list.jwt")
-    with open(jwt_file_path, "w") as f:
-        f.write(
-            jwt_format(
-                specific_status_list["token_status_list"],
-                country,
-                cfgservice.service_url
-                + f"token_status_list/{country}/{doctype}/{rand}",
-            )
-        )
+    publish_list(specific_status_list, country, doctype)
+    save_list_state(specific_status_list, country, doctype)
 
-    cwt_file_path = os.path.join(directory, "token_status_list.cwt")
-    with open(cwt_file_path, "wb") as f:
-        f.write(
-            cwt_format(
-                specific_status_list["token_status_list"],
-                country,
-                cfgservice.service_url
-                + f"token_status_list/{country}/{doctype}/{rand}",
-            )
-        )
 
-    specific_status_list.update(
-        {
-            "status_list_uri": cfgservice.service_url
-            + f"token_status_list/{country}/{doctype}/{rand}"
-        }
-    )
-    ##
-    identifier_list_directory = (
-        f"{cfgservice.status_list_dir}/identifier_list/{country}/{doctype}/{rand}"
-    )
+def list_state_directory(uri):
+    """
+    Returns the directory holding the state of a list. Token status list and identifier
+    list uris of the same list share their state, stored in the token status list directory.
 
-    os.makedirs(identifier_list_directory, exist_ok=True)
+    Args:
+        uri (str): uri pointing to the status list or the identifier list
 
-    json_file_path = os.path.join(identifier_list_directory, "full_list.json")
-    with open(json_file_path, "w") as f:
-        f.write(json.dumps(dict_copy))
+    Returns:
+        str: path of the directory
+    """
 
-    jwt_file_path = os.path.join(identifier_list_directory, "identifier_list.jwt")
-    with open(jwt_file_path, "w") as f:
-        f.write(
-            identifier_list_jwt_format(
-                specific_status_list["identifier_list"],
-                country,
-                cfgservice.service_url + f"identifier_list/{country}/{doctype}/{rand}",
-            )
-        )
+    path_parts = urlparse(uri).path.split("/")
 
-    cwt_file_path = os.path.join(identifier_list_directory, "identifier_list.cwt")
-    with open(cwt_file_path, "wb") as f:
-        f.write(
-            identifier_list_cwt_format(
-                specific_status_list["identifier_list"],
-                country,
-                cfgservice.service_url + f"identifier_list/{country}/{doctype}/{rand}",
-            )
-        )
+    if len(path_parts) != 5:
+        raise ValueError(f"Invalid list uri: {uri}")
 
-    specific_status_list.update(
-        {
-            "identifier_list_uri": cfgservice.service_url
-            + f"identifier_list/{country}/{doctype}/{rand}"
-        }
-    )
+    return list_directory("token_status_list", *path_parts[2:])
 
 
 def load_list(uri):
@@ -171,110 +904,430 @@ def load_list(uri):
         dict: The loaded list
     """
 
-    parsed_uri = urlparse(uri)
-    path = parsed_uri.path
+    directory = list_state_directory(uri)
 
-    folder_path = f"{cfgservice.status_list_dir}{path}/full_list.json"
+    # Lists changed since they were saved are only up to date in memory
+    temp_list = list_journal.unsaved_list(directory)
+    if temp_list is not None:
+        return temp_list
 
-    with open(folder_path, "r") as json_file:
-        temp_list = json.load(json_file)
+    return read_list_state(directory)
 
-    temp_list["token_status_list"] = IssuerStatusList.load(
-        temp_list["token_status_list"]
-    )
+
+def get_list(uri):
+    """
+    Returns a list for read only use. Parsed lists are kept in a LRU cache and only
+    read again from disk when their file changed.
+
+    Args:
+        uri (str): uri pointing to the status list
+
+    Returns:
+        dict: The list, which must not be modified
+    """
+
+    directory = list_state_directory(uri)
+
+    temp_list = list_journal.unsaved_list(directory)
+    if temp_list is not None:
+        return temp_list
+
+    file_state = _file_state(state_file(directory))
+
+    with list_cache_lock:
+        cached = list_cache.get(directory)
+        if cached is not None and cached[0] == file_state:
+            list_cache.move_to_end(directory)
+            return cached[1]
+
+    temp_list = read_list_state(directory)
+
+    with list_cache_lock:
+        list_cache[directory] = (file_state, temp_list)
+        list_cache.move_to_end(directory)
+        while len(list_cache) > cfgservice.list_cache_size:
+            list_cache.popitem(last=False)
 
     return temp_list
 
 
-def take_index_list(country, doctype, expiry_date):
+def invalidate_cached_list(directory):
     """
-    Takes a new index/id from list
+    Removes a list from the cache used by get_list
+
+    Args:
+        directory (str): token status list directory of the list
+    """
+
+    with list_cache_lock:
+        list_cache.pop(directory, None)
+
+
+def remove_list(directory, country, doctype) -> bool:
+    """
+    Removes an expired list from disk, and from the current and prepared lists of this
+    process, unless it still has unsaved changes or is owned by another running
+    process, which may still take indexes from it
 
     Args:
+        directory (str): token status list directory of the list
         country (str): country code
         doctype (str): doctype of the attestation
-        expiry_date (str): expiry date of the attestation
 
     Returns:
-        str: The index/id
+        bool: whether the list was removed
+    """
+
+    with get_list_lock(country, doctype):
+        # Unsaved changes would recreate the list when saved
+        if list_journal.unsaved_list(directory) is not None:
+            return False
+
+        if not claim_list(directory):
+            return False
+
+        rand = os.path.basename(directory)
+
+        with lists_lock:
+            current = status_list.get(country, {}).get(doctype)
+            if current is not None and current["rand"] == rand:
+                del status_list[country][doctype]
+
+            prepared = next_lists.get((country, doctype))
+            if prepared is not None and prepared["rand"] == rand:
+                del next_lists[(country, doctype)]
+
+        shutil.rmtree(directory)
+        shutil.rmtree(identifier_list_directory(directory), ignore_errors=True)
+        invalidate_cached_list(directory)
+        release_list(directory)
+
+    return True
+
+
+def update_expiry(specific_status_list, expiry_date):
+    """
+    Extends the expiry of a list to cover the expiry date of a new attestation
+
+    Args:
+        specific_status_list (dict): status list to update
+        expiry_date (str): expiry date of the attestation
     """
 
-    global status_list
+    if specific_status_list["expires"] is None:
+        specific_status_list["expires"] = expiry_date
+    else:
+        new_exp = datetime.strptime(expiry_date, "%Y-%m-%d")
+        current_exp = datetime.strptime(specific_status_list["expires"], "%Y-%m-%d")
+        if new_exp > current_exp:
+            specific_status_list["expires"] = expiry_date
 
-    if country not in status_list:
-        status_list.update({country: {}})
 
-    if doctype not in status_list[country]:
-        status_list[country].update(
+def persist_taken_list(specific_status_list, country, doctype, indexes):
+    """
+    Persists a list after indexes were taken from it
+
+    Args:
+        specific_status_list (dict): status list to persist
+        country (str): country code
+        doctype (str): doctype of the attestation
+        indexes (list): indexes taken
+    """
+
+    # Allocating an index doesn't change any published status, so the list
+    # only has to be signed the first time, for its URIs to exist
+    if "status_list_uri" in specific_status_list:
+        rand = specific_status_list["rand"]
+        list_journal.append(
             {
-                doctype: {
-                    "token_status_list": IssuerStatusList.new(
-                        1, cfgservice.token_status_list_size, "random"
-                    ),
-                    "identifier_list": {},
-                    "expires": expiry_date,
-                    "rand": str(uuid4()),
-                }
-            }
+                "t": "take",
+                "c": country,
+                "d": doctype,
+                "r": rand,
+                "i": indexes,
+                "e": specific_status_list["expires"],
+            },
+            list_directory("token_status_list", country, doctype, rand),
+            specific_status_list,
+            country,
+            doctype,
         )
+    else:
+        dump_list(specific_status_list, country, doctype)
+
+
+def scan_country_lists(country):
+    """
+    Finds, for each doctype of a country, the list on disk that can still take indexes,
+    and claims it. When several can, the fullest one not owned by another process is
+    chosen.
+
+    Args:
+        country (str): country code
+
+    Returns:
+        dict: The lists found, by doctype
+    """
+
+    country_dir = f"{cfgservice.status_list_dir}/token_status_list/{country}"
+    now = time.time()
+    found = {}
+
+    if not os.path.isdir(country_dir):
+        return found
+
+    for doctype in os.listdir(country_dir):
+        candidates = []
+
+        for rand in os.listdir(os.path.join(country_dir, doctype)):
+            directory = os.path.join(country_dir, doctype, rand)
+
+            try:
+                migrate_list(directory)
+                header = read_list_header(directory)
+            except Exception:
+                cfgservice.app_logger.info(
+                    f"Skipping unreadable list {directory}", exc_info=True
+                )
+                continue
+
+            if (
+                "status_list_uri" not in header
+                or header["expires"] is None
+                or expiry_timestamp(header["expires"]) <= now
+            ):
+                continue
+
+            fill = header_fill_ratio(header)
+            if fill < 1:
+                candidates.append((fill, directory))
+
+        # Lists resumed by another running process are left to it
+        for _, directory in sorted(candidates, reverse=True):
+            if claim_list(directory):
+                # Read once claimed, after any change saved by the previous owner
+                temp_list = read_list_state(directory)
+                del temp_list["country"], temp_list["doctype"]
+                found[doctype] = temp_list
+                break
+
+    cfgservice.app_logger.info(f"Found {len(found)} lists to resume for {country}")
+
+    return found
+
+
+def start_rehydration():
+    """
+    Starts scanning, in parallel, the lists of every country left on disk by previous runs.
+    Each country waits for its scan only when it first takes an index.
+    """
+
+    executor = ThreadPoolExecutor(max_workers=cfgservice.rehydration_workers)
+
+    with lists_lock:
+        for country in cfgservice.countries:
+            rehydration_scans[country] = executor.submit(scan_country_lists, country)
+
+    executor.shutdown(wait=False)
+
+
+def rehydrate_country(country):
+    """
+    Waits for the scan of a country, if still pending, and resumes the lists it found
+
+    Args:
+        country (str): country code
+    """
+
+    scan = rehydration_scans.get(country)
+
+    if scan is None:
+        return
 
     try:
-        index = status_list[country][doctype]["token_status_list"].allocator.take()
-
-        if status_list[country][doctype]["expires"] is None:
-            status_list[country][doctype]["expires"] = expiry_date
-        else:
-            new_exp = datetime.strptime(expiry_date, "%Y-%m-%d")
-            current_exp = datetime.strptime(
-                status_list[country][doctype]["expires"], "%Y-%m-%d"
+        found = scan.result()
+    except Exception:
+        cfgservice.app_logger.error(
+            f"Failed to scan the lists of {country}", exc_info=True
+        )
+        found = {}
+
+    with lists_lock:
+        if rehydration_scans.pop(country, None) is None:
+            return
+
+        unused = []
+
+        for doctype, temp_list in found.items():
+            current = status_list.setdefault(country, {}).setdefault(doctype, temp_list)
+
+            # Lists created meanwhile are used instead, the resumed ones are left
+            # to other processes
+            if current["rand"] != temp_list["rand"]:
+                unused.append(
+                    list_directory(
+                        "token_status_list", country, doctype, temp_list["rand"]
+                    )
+                )
+
+    for directory in unused:
+        release_list(directory)
+
+
+def get_current_list(country, doctype, expiry_date):
+    """
+    Returns the list currently used for a country and doctype, resuming it from disk
+    or creating it if needed. Must be called holding the lock of the list.
+
+    Args:
+        country (str): country code
+        doctype (str): doctype of the attestation
+        expiry_date (str): expiry date of the attestation
+
+    Returns:
+        dict: The current list
+    """
+
+    rehydrate_country(country)
+
+    specific_status_list = status_list.get(country, {}).get(doctype)
+
+    if specific_status_list is None:
+        specific_status_list = new_list(country, doctype, expiry_date)
+
+    return specific_status_list
+
+
+def roll_over_list(country, doctype):
+    """
+    Replaces a full list by the next one, prepared ahead of time when possible.
+    Lists of other countries and doctypes are kept.
+    Must be called holding the lock of the list.
+
+    Args:
+        country (str): country code
+        doctype (str): doctype of the attestation
+
+    Returns:
+        dict: The new list
+    """
+
+    with lists_lock:
+        previous = status_list.get(country, {}).get(doctype)
+        specific_status_list = next_lists.pop((country, doctype), None)
+
+        # Prepared lists keep the expiry of the list they replace, they are dropped
+        # when removed as expired
+        if specific_status_list is not None and not os.path.exists(
+            state_file(
+                list_directory(
+                    "token_status_list", country, doctype, specific_status_list["rand"]
+                )
             )
-            if new_exp > current_exp:
-                status_list[country][doctype]["expires"] = expiry_date
+        ):
+            specific_status_list = None
 
-        print(
-            "\nStatus List Expiry Changed to: ",
-            status_list[country][doctype]["expires"],
-            flush=True,
-        )
+        if specific_status_list is not None:
+            status_list[country][doctype] = specific_status_list
 
-        dump_list(status_list[country][doctype], country, doctype)
-    except NoMoreIndices as e:
-        dump_list(status_list[country][doctype], country, doctype)
-        status_list = {}
-        new_list(country, doctype)
-        index = status_list[country][doctype]["token_status_list"].allocator.take()
-        dump_list(status_list[country][doctype], country, doctype)
+    if specific_status_list is None:
+        specific_status_list = new_list(country, doctype, previous=previous)
 
-    # status_list[doctype]["identifier_list"].update({str(index): {"status": 0}})
-    # print(status_list)
-    return index
+    return specific_status_list
 
 
-def generate_StatusListInfo(country, doctype, expiry_date):
+def take_indexes(country, doctype, expiry_date, count):
     """
-    Generates the structure sent to the issuer
+    Takes several indexes/ids, rolling over to new lists when the current one is full.
+    Each list used is persisted once, after all indexes are taken.
 
     Args:
         country (str): country code
         doctype (str): doctype of the attestation
         expiry_date (str): expiry date of the attestation
+        count (int): number of indexes to take
 
     Returns:
-        dict: structure to pass to the issuer
+        list: (list, index) pairs, with the list each index was taken from
+    """
+
+    taken = []
+
+    with get_list_lock(country, doctype):
+        specific_status_list = get_current_list(country, doctype, expiry_date)
+        used_lists = [specific_status_list]
+
+        while len(taken) < count:
+            try:
+                index = specific_status_list["token_status_list"].allocator.take()
+            except NoMoreIndices:
+                specific_status_list = roll_over_list(country, doctype)
+                used_lists.append(specific_status_list)
+                continue
+
+            taken.append((specific_status_list, index))
+
+        for specific_status_list in used_lists:
+            update_expiry(specific_status_list, expiry_date)
+            persist_taken_list(
+                specific_status_list,
+                country,
+                doctype,
+                [index for used, index in taken if used is specific_status_list],
+            )
+
+        # Full lists no longer take indexes
+        for full_list in used_lists[:-1]:
+            release_list(
+                list_directory("token_status_list", country, doctype, full_list["rand"])
+            )
+
+        prepare_next_list_if_needed(specific_status_list, country, doctype)
+
+    metrics.increment("indexes_taken_total", count, country=country, doctype=doctype)
+
+    return taken
+
+
+def take_index_list(country, doctype, expiry_date):
+    """
+    Takes a new index/id from list
+
+    Args:
+        country (str): country code
+        doctype (str): doctype of the attestation
+        expiry_date (str): expiry date of the attestation
+
+    Returns:
+        str: The index/id
+    """
+
+    [(_, index)] = take_indexes(country, doctype, expiry_date, 1)
+
+    # status_list[doctype]["identifier_list"].update({str(index): {"status": 0}})
+    # print(status_list)
+    return index
+
+
+def status_list_info(specific_status_list, index):
     """
+    Builds the structure sent to the issuer for an index of a list
 
-    index = take_index_list(country, doctype, expiry_date)
+    Args:
+        specific_status_list (dict): list the index was taken from
+        index (int): the index/id
 
-    status_list_uri = status_list[country][doctype]["status_list_uri"]
-    identifier_list_uri = status_list[country][doctype]["identifier_list_uri"]
+    Returns:
+        dict: structure to pass to the issuer
+    """
 
     StatusListInfo = {
         "status_list": {
-            "uri": status_list_uri,
+            "uri": specific_status_list["status_list_uri"],
             "idx": index,
         },
         "identifier_list": {
-            "uri": identifier_list_uri,
+            "uri": specific_status_list["identifier_list_uri"],
             "id": str(index),
         },
     }
@@ -282,18 +1335,99 @@ def generate_StatusListInfo(country, doctype, expiry_date):
     return StatusListInfo
 
 
-# in case where status list is still the same
-def update_status_list(country, doctype, id, index):
-    print("\nRevoking country: ", country)
-    print("\nRevoking doctype: ", doctype)
-    print("\nRevoking ID: ", id)
+def generate_StatusListInfo(country, doctype, expiry_date):
+    """
+    Generates the structure sent to the issuer
 
-    if (
-        country in status_list
-        and doctype in status_list[country]
-        and status_list[country][doctype]["rand"] == id
-    ):
-        status_list[country][doctype]["token_status_list"].status_list.set(index, 1)
+    Args:
+        country (str): country code
+        doctype (str): doctype of the attestation
+        expiry_date (str): expiry date of the attestation
+
+    Returns:
+        dict: structure to pass to the issuer
+    """
+
+    [(specific_status_list, index)] = take_indexes(country, doctype, expiry_date, 1)
+
+    return status_list_info(specific_status_list, index)
+
+
+def generate_StatusListInfo_batch(country, doctype, expiry_date, count):
+    """
+    Generates the structures sent to the issuer for several attestations
+
+    Args:
+        country (str): country code
+        doctype (str): doctype of the attestation
+        expiry_date (str): expiry date of the attestations
+        count (int): number of attestations
+
+    Returns:
+        list: structures to pass to the issuer, one per attestation
+    """
+
+    return [
+        status_list_info(specific_status_list, index)
+        for specific_status_list, index in take_indexes(
+            country, doctype, expiry_date, count
+        )
+    ]
+
+
+def set_list_statuses(uri, country, doctype, id, changes):
+    """
+    Changes the status of several indexes/ids of a list and saves it once.
+    The list in use for taking indexes is changed in place, other lists are read from disk.
+
+    Args:
+        uri (str): uri pointing to the list
+        country (str): country code
+        doctype (str): doctype of the attestation
+        id (str): random identifier of the list
+        changes (list): (index, status) pairs
+
+    Returns:
+        tuple: the changed list and, for each change, None or the error message
+    """
+
+    errors = []
+
+    with get_list_lock(country, doctype):
+        rehydrate_country(country)
+
+        specific_status_list = status_list.get(country, {}).get(doctype)
+
+        if specific_status_list is None or specific_status_list["rand"] != id:
+            specific_status_list = load_list(uri)
+
+        for index, status in changes:
+            try:
+                if index < 0:
+                    raise ValueError("Invalid index; out of range")
+
+                # Rejects statuses wider than the list, and changes of invalid indexes
+                specific_status_list["token_status_list"][index] = status
+            except (IndexError, ValueError) as e:
+                errors.append(str(e))
+                continue
+
+            specific_status_list["identifier_list"].set(index, status)
+            errors.append(None)
+
+        applied = [
+            [index, status]
+            for (index, status), error in zip(changes, errors)
+            if error is None
+        ]
+
+        if applied:
+            list_journal.append(
+                {"t": "set", "c": country, "d": doctype, "r": id, "s": applied},
+                list_directory("token_status_list", country, doctype, id),
+                specific_status_list,
+                country,
+                doctype,
+            )
 
-        if "identifier_list" in status_list[country][doctype]:
-            status_list[country][doctype]["identifier_list"].update({str(index): 1})
+    return specific_status_list, errors
@@ -0,0 +1,96 @@
+# coding: latin-1
+###############################################################################
+# Copyright (c) 2023 European Commission
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+###############################################################################
+import atexit
+import threading
+import time
+
+from app.config_service import ConfService as cfgservice
+from app.list_management import get_list_lock, publish_list
+
+# Lists whose published artifacts are out of date, by (country, doctype, rand)
+dirty_lists = {}
+
+dirty_lists_lock = threading.Lock()
+
+
+def mark_dirty(specific_status_list, country, doctype):
+    """
+    Marks a list as changed, so that it is re-signed on the next flush. Lists marked
+    several times between two flushes are only signed once.
+
+    Args:
+        specific_status_list (dict): status list that changed
+        country (str): country code
+        doctype (str): doctype of the attestation
+    """
+
+    if cfgservice.publish_interval <= 0:
+        with get_list_lock(country, doctype):
+            publish_list(specific_status_list, country, doctype)
+        return
+
+    with dirty_lists_lock:
+        dirty_lists[(country, doctype, specific_status_list["rand"])] = (
+            specific_status_list
+        )
+
+
+def flush_lists():
+    """
+    Re-signs every list marked as changed since the last flush
+
+    Returns:
+        int: number of lists published
+    """
+
+    with dirty_lists_lock:
+        pending = dict(dirty_lists)
+        dirty_lists.clear()
+
+    published = 0
+
+    for (country, doctype, rand), specific_status_list in pending.items():
+        try:
+            with get_list_lock(country, doctype):
+                publish_list(specific_status_list, country, doctype)
+            published += 1
+        except Exception:
+            cfgservice.app_logger.error(
+                f"Failed to publish list {country}/{doctype}/{rand}", exc_info=True
+            )
+            # Keep it for the next flush, unless it was marked again meanwhile
+            with dirty_lists_lock:
+                dirty_lists.setdefault((country, doctype, rand), specific_status_list)
+
+    return published
+
+
+def publish_periodically():
+    while True:
+        time.sleep(cfgservice.publish_interval)
+        flush_lists()
+
+
+def start_publisher_thread():
+    if cfgservice.publish_interval <= 0:
+        return
+
+    atexit.register(flush_lists)
+
+    task_thread = threading.Thread(target=publish_periodically, daemon=True)
+    task_thread.start()
@@ -0,0 +1,551 @@
+# coding: latin-1
+###############################################################################
+# Copyright (c) 2023 European Commission
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+###############################################################################
+"""
+Binary on-disk state of the lists.
+
+The state of a list is stored once, in the token status list directory, as:
+
+    prefix     magic, version, bits, header length and status list length
+    header     json metadata (country, doctype, expiry, uris, allocator, ...)
+    status     raw status list bitstring
+    allocated  raw bitmap of the taken indexes (random allocator only)
+    ids        identifier list ids, little endian uint32
+    statuses   identifier list statuses, uint8
+
+The header can be read without the rest of the file, and statuses can be read
+through mmap without parsing anything but the fixed size prefix.
+
+Next to it, signature.json records when the published artifacts were signed and the
+hash of the content they were signed from, so that renewal can tell fresh lists from
+lists that are due or changed since.
+"""
+import hashlib
+import json
+import mmap
+import os
+import struct
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+from token_status_list import (
+    BitArray,
+    IssuerStatusList,
+    LinearIndexAllocator,
+    RandomIndexAllocator,
+)
+
+from app import metrics
+from app.config_service import ConfService as cfgservice
+from app.identifier_list_store import IdentifierList
+
+STATE_FILE = "list_state.bin"
+
+SIGNATURE_FILE = "signature.json"
+
+# State file written by previous versions, in both list directories
+LEGACY_STATE_FILE = "full_list.json"
+
+MAGIC = b"TSLS"
+
+VERSION = 1
+
+# magic, version, bits, reserved, header length, status list length
+PREFIX = struct.Struct("<4sBBHII")
+
+# Memory mapped state files used by lookup_status, by directory
+mapped_lists = OrderedDict()
+
+mapped_lists_lock = threading.Lock()
+
+
+def write_file(path: str, data):
+    """
+    Writes a file aside and renames it, so that readers never see a partial file.
+    Each writer has its own temporary file, as processes may write the same file.
+
+    Args:
+        path (str): path of the file
+        data (bytes | str): content of the file
+    """
+
+    temporary = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+
+    with metrics.timed("file_write_seconds"):
+        with open(temporary, "wb" if isinstance(data, bytes) else "w") as f:
+            f.write(data)
+
+        os.replace(temporary, path)
+
+    metrics.increment("file_write_bytes_total", len(data))
+
+
+def state_file(directory: str) -> str:
+    """
+    Returns the path of the file holding the state of a list, which is the legacy
+    json file for lists not migrated yet
+
+    Args:
+        directory (str): token status list directory of the list
+
+    Returns:
+        str: path of the state file
+    """
+
+    path = os.path.join(directory, STATE_FILE)
+
+    if not os.path.exists(path):
+        legacy_path = os.path.join(directory, LEGACY_STATE_FILE)
+        if os.path.exists(legacy_path):
+            return legacy_path
+
+    return path
+
+
+def write_list_state(directory: str, specific_status_list: dict, country, doctype):
+    """
+    Writes the state of a list in the binary format
+
+    Args:
+        directory (str): token status list directory of the list
+        specific_status_list (dict): the list
+        country (str): country code
+        doctype (str): doctype of the attestation
+    """
+
+    token_status_list = specific_status_list["token_status_list"]
+    allocator = token_status_list.allocator
+
+    header = {
+        key: value
+        for key, value in specific_status_list.items()
+        if key not in ("token_status_list", "identifier_list")
+    }
+    header["country"] = country
+    header["doctype"] = doctype
+
+    if isinstance(allocator, RandomIndexAllocator):
+        header["allocator"] = {
+            "type": "random",
+            "num_allocated": allocator.num_allocated,
+            "size": allocator.allocated.size,
+        }
+        allocated = bytes(allocator.allocated.lst)
+    else:
+        header["allocator"] = allocator.dump()
+        allocated = b""
+
+    ids, statuses = specific_status_list["identifier_list"].to_bytes()
+    header["sections"] = [len(allocated), len(ids), len(statuses)]
+
+    with metrics.timed("json_seconds", operation="dumps"):
+        header_bytes = json.dumps(header).encode()
+    status_bytes = bytes(token_status_list.status_list.lst)
+
+    prefix = PREFIX.pack(
+        MAGIC,
+        VERSION,
+        token_status_list.status_list.bits,
+        0,
+        len(header_bytes),
+        len(status_bytes),
+    )
+
+    write_file(
+        os.path.join(directory, STATE_FILE),
+        b"".join((prefix, header_bytes, status_bytes, allocated, ids, statuses)),
+    )
+
+
+def content_hash(status: bytes, ids: bytes, statuses: bytes) -> str:
+    """
+    Returns the hash of the statuses of a list, as published in its artifacts
+
+    Args:
+        status (bytes): raw status list bitstring
+        ids (bytes): raw identifier list ids
+        statuses (bytes): raw identifier list statuses
+
+    Returns:
+        str: hex encoded sha256
+    """
+
+    digest = hashlib.sha256()
+    for part in (status, ids, statuses):
+        digest.update(len(part).to_bytes(8, "little"))
+        digest.update(part)
+
+    return digest.hexdigest()
+
+
+def list_content_hash(specific_status_list: dict) -> str:
+    """
+    Returns the content hash of a list in memory
+
+    Args:
+        specific_status_list (dict): the list
+
+    Returns:
+        str: hex encoded sha256
+    """
+
+    return content_hash(
+        bytes(specific_status_list["token_status_list"].status_list.lst),
+        *specific_status_list["identifier_list"].to_bytes(),
+    )
+
+
+def read_content_hash(directory: str) -> str:
+    """
+    Returns the content hash of a list from its state file, without parsing it
+
+    Args:
+        directory (str): token status list directory of the list
+
+    Returns:
+        str: hex encoded sha256
+    """
+
+    with open(os.path.join(directory, STATE_FILE), "rb") as f:
+        data = f.read()
+
+    _, header_length, status_length = _unpack_prefix(data)
+
+    offset = PREFIX.size
+    allocated_length, ids_length, statuses_length = json.loads(
+        data[offset : offset + header_length]
+    )["sections"]
+    offset += header_length
+
+    status = data[offset : offset + status_length]
+    offset += status_length + allocated_length
+    ids = data[offset : offset + ids_length]
+    offset += ids_length
+
+    return content_hash(status, ids, data[offset : offset + statuses_length])
+
+
+def read_signature(directory: str) -> dict:
+    """
+    Reads when the artifacts of a list were last signed, and from which content
+
+    Args:
+        directory (str): token status list directory of the list
+
+    Returns:
+        dict: signed_at timestamp, content_hash and compressed_hash of the published
+        bitstring, None if the list was never signed or was signed by a previous
+        version
+    """
+
+    try:
+        with open(os.path.join(directory, SIGNATURE_FILE), "r") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def _unpack_prefix(data) -> tuple:
+    """
+    Parses and checks the fixed size prefix of a state file
+
+    Returns:
+        tuple: bits, header length and status list length
+    """
+
+    magic, version, bits, _, header_length, status_length = PREFIX.unpack_from(data)
+
+    if magic != MAGIC or version != VERSION:
+        raise ValueError("Not a list state file")
+
+    return bits, header_length, status_length
+
+
+def read_list_header(directory: str) -> dict:
+    """
+    Reads the metadata of a list, without its statuses
+
+    Args:
+        directory (str): token status list directory of the list
+
+    Returns:
+        dict: the header, with the bits of the status list
+    """
+
+    with open(os.path.join(directory, STATE_FILE), "rb") as f:
+        bits, header_length, _ = _unpack_prefix(f.read(PREFIX.size))
+        header = json.loads(f.read(header_length))
+
+    header["bits"] = bits
+
+    return header
+
+
+def expiry_timestamp(expires: str) -> float:
+    """
+    Returns when a list expires. Lists cover attestations valid through their expiry
+    date, so they expire at the end of that day.
+
+    Args:
+        expires (str): expiry date of the list, as YYYY-MM-DD
+
+    Returns:
+        float: timestamp from which the list can be removed
+    """
+
+    return (datetime.strptime(expires, "%Y-%m-%d") + timedelta(days=1)).timestamp()
+
+
+def header_fill_ratio(header: dict) -> float:
+    """
+    Returns the fraction of the indexes of a list already taken, from its header
+
+    Args:
+        header (dict): header of the list
+
+    Returns:
+        float: ratio between 0 and 1
+    """
+
+    allocator = header["allocator"]
+
+    if allocator["type"] == "random":
+        return allocator["num_allocated"] / allocator["size"]
+
+    return allocator["next"] / allocator["size"]
+
+
+def read_legacy_list(path: str) -> dict:
+    """
+    Reads a list from the json state file of previous versions
+
+    Args:
+        path (str): path of the full_list.json file
+
+    Returns:
+        dict: The loaded list
+    """
+
+    with open(path, "r") as json_file:
+        temp_list = json.load(json_file)
+
+    temp_list["token_status_list"] = IssuerStatusList.load(
+        temp_list["token_status_list"]
+    )
+    temp_list["identifier_list"] = IdentifierList.load(temp_list["identifier_list"])
+
+    return temp_list
+
+
+def read_list_state(directory: str) -> dict:
+    """
+    Reads the full state of a list
+
+    Args:
+        directory (str): token status list directory of the list
+
+    Returns:
+        dict: The loaded list
+    """
+
+    path = state_file(directory)
+
+    if path.endswith(LEGACY_STATE_FILE):
+        return read_legacy_list(path)
+
+    with open(path, "rb") as f:
+        data = f.read()
+
+    bits, header_length, status_length = _unpack_prefix(data)
+
+    offset = PREFIX.size
+    with metrics.timed("json_seconds", operation="loads"):
+        temp_list = json.loads(data[offset : offset + header_length])
+    offset += header_length
+
+    parts = []
+    for length in [status_length] + temp_list.pop("sections"):
+        parts.append(data[offset : offset + length])
+        offset += length
+    status, allocated, ids, statuses = parts
+
+    allocator = temp_list.pop("allocator")
+    if allocator["type"] == "random":
+        allocator = RandomIndexAllocator(
+            BitArray(1, allocated), allocator["num_allocated"]
+        )
+    else:
+        allocator = LinearIndexAllocator.load(allocator)
+
+    temp_list["token_status_list"] = IssuerStatusList(BitArray(bits, status), allocator)
+    temp_list["identifier_list"] = IdentifierList.from_bytes(ids, statuses)
+
+    return temp_list
+
+
+def _map_list(path: str, file_state: tuple) -> tuple:
+    """
+    Memory maps a state file
+
+    Args:
+        path (str): path of the state file
+        file_state (tuple): inode, modification time and size of the file
+
+    Returns:
+        tuple: file state, mmap, offset of the status list, its length, bits, values
+        per byte and mask
+    """
+
+    with open(path, "rb") as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    bits, header_length, status_length = _unpack_prefix(data)
+
+    return (
+        file_state,
+        data,
+        PREFIX.size + header_length,
+        status_length,
+        bits,
+        8 // bits,
+        (1 << bits) - 1,
+    )
+
+
+def lookup_status(directory: str, index: int) -> int:
+    """
+    Returns the status of an index from the memory mapped state file of the list.
+    Mappings are kept open, in a LRU of mapped_lists_size entries, and remapped when
+    the file is replaced, so lookups of hot lists are served from the page cache.
+
+    Args:
+        directory (str): token status list directory of the list
+        index (int): the index
+
+    Returns:
+        int: the status
+    """
+
+    path = os.path.join(directory, STATE_FILE)
+    stat = os.stat(path)
+    file_state = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+    with mapped_lists_lock:
+        mapped = mapped_lists.get(directory)
+        if mapped is not None and mapped[0] == file_state:
+            mapped_lists.move_to_end(directory)
+
+    if mapped is None or mapped[0] != file_state:
+        mapped = _map_list(path, file_state)
+
+        with mapped_lists_lock:
+            mapped_lists[directory] = mapped
+            while len(mapped_lists) > cfgservice.mapped_lists_size:
+                # Not closed explicitly, a concurrent lookup may still be using it
+                mapped_lists.popitem(last=False)
+
+    _, data, offset, length, bits, per_byte, mask = mapped
+    byte_index = index // per_byte
+
+    if index < 0 or byte_index >= length:
+        raise IndexError("Index is out of bounds")
+
+    return (data[offset + byte_index] >> ((index % per_byte) * bits)) & mask
+
+
+def identifier_list_directory(directory: str) -> str:
+    """
+    Returns the identifier list directory of a list
+
+    Args:
+        directory (str): token status list directory of the list
+
+    Returns:
+        str: the identifier list directory
+    """
+
+    relative_path = os.path.relpath(
+        directory, os.path.join(cfgservice.status_list_dir, "token_status_list")
+    )
+
+    return os.path.join(cfgservice.status_list_dir, "identifier_list", relative_path)
+
+
+def migrate_list(directory: str) -> bool:
+    """
+    Converts the json state of a list saved by previous versions to the binary format,
+    and removes the json copies from both list directories
+
+    Args:
+        directory (str): token status list directory of the list
+
+    Returns:
+        bool: whether a json state file was found
+    """
+
+    legacy_path = os.path.join(directory, LEGACY_STATE_FILE)
+
+    if not os.path.exists(legacy_path):
+        return False
+
+    # A binary state is always newer than the json one left next to it
+    if not os.path.exists(os.path.join(directory, STATE_FILE)):
+        temp_list = read_legacy_list(legacy_path)
+        write_list_state(
+            directory, temp_list, temp_list.pop("country"), temp_list.pop("doctype")
+        )
+
+    os.remove(legacy_path)
+
+    identifier_legacy_path = os.path.join(
+        identifier_list_directory(directory), LEGACY_STATE_FILE
+    )
+    if os.path.exists(identifier_legacy_path):
+        os.remove(identifier_legacy_path)
+
+    return True
+
+
+def migrate_lists() -> int:
+    """
+    Migrates every list of status_list_dir still saved in the json format
+
+    Returns:
+        int: number of lists migrated
+    """
+
+    migrated = 0
+
+    for root, _, files in os.walk(
+        os.path.join(cfgservice.status_list_dir, "token_status_list")
+    ):
+        if LEGACY_STATE_FILE in files:
+            try:
+                migrated += migrate_list(root)
+            except Exception:
+                cfgservice.app_logger.error(
+                    f"Failed to migrate list {root}", exc_info=True
+                )
+
+    cfgservice.app_logger.info(f"Migrated {migrated} lists to the binary format")
+
+    return migrated
+
+
+if __name__ == "__main__":
+    migrate_lists()
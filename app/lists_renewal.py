@@ -15,157 +15,377 @@
 # limitations under the License.
 #
 ###############################################################################
-import json
-import shutil
-import sys
-import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 import time
-from datetime import datetime, timedelta
+import uuid
+from datetime import datetime
 import os
+from app import metrics
+from app.backup_store import (
+    SNAPSHOT_FORMAT,
+    backup_files,
+    backup_lock,
+    complete_snapshot,
+    prune_backups_if_due,
+    write_snapshot,
+)
 from app.config_service import ConfService as cfgservice
-from app.status_list_format import cwt_format, jwt_format
-from app.identifier_list_format import (
-    identifier_list_cwt_format,
-    identifier_list_jwt_format,
+from app.list_management import (
+    get_list_lock,
+    publish_list,
+    remove_list,
+    sign_list,
+    write_artifacts,
+)
+from app.list_journal import unsaved_list
+from app.list_publisher import flush_lists
+from app.list_storage import (
+    LEGACY_STATE_FILE,
+    STATE_FILE,
+    expiry_timestamp,
+    identifier_list_directory,
+    migrate_list,
+    read_content_hash,
+    read_list_header,
+    read_list_state,
+    read_signature,
 )
 
-# current_dir = os.path.dirname(os.path.abspath(__file__))
-# sys.path.append(os.path.join(current_dir, '..', 'token-status-list-py'))
-from token_status_list import IssuerStatusList
-
-
-def renew_lists():
-    """
-    Renews all the status lists that haven't expired
-    """
-    base_dir = cfgservice.status_list_dir
-    backup_dir = cfgservice.backup_dir
-    timestamp = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
-
-    # Traverse subdirectories
-    for root, _, files in os.walk(base_dir):
-        for file in files:
-            if file == "full_list.json":
-                file_path = os.path.join(root, file)
-                dir_path = root
-
-                try:
-                    with open(file_path, "r") as json_file:
-                        temp_list = json.load(json_file)
-                except Exception as e:
-                    cfgservice.app_logger.info(
-                        f"An error occurred while processing the file: {file_path}",
-                        exc_info=True,
-                    )
-                    continue
-
-                if (
-                    "status_list_uri" not in temp_list
-                    or "identifier_list_uri" not in temp_list
-                ):
-                    cfgservice.app_logger.info(f"Uris don't exist: {file_path}")
-                    continue
-
-                expires_date = datetime.strptime(temp_list["expires"], "%Y-%m-%d")
-
-                if expires_date < datetime.now():
-                    cfgservice.app_logger.info(f"Removing {dir_path} as it is expired.")
-                    shutil.rmtree(dir_path)
-                    continue
-
-                relative_path = os.path.relpath(root, base_dir)
-                copy_dir = os.path.join(backup_dir, timestamp, relative_path)
-                os.makedirs(copy_dir, exist_ok=True)
-
-                if "token_status_list" in dir_path:
-                    list_type = "token_status_list"
-
-                    shutil.copy(dir_path + "/token_status_list.jwt", copy_dir)
-                    shutil.copy(dir_path + "/token_status_list.cwt", copy_dir)
-                    shutil.copy(dir_path + "/full_list.json", copy_dir)
-
-                    temp_list["token_status_list"] = IssuerStatusList.load(
-                        temp_list["token_status_list"]
-                    )
-                    # temp_list[list_type] = temp_list[list_type].dump()
-
-                    jwt_file_path = os.path.join(dir_path, "token_status_list.jwt")
-                    with open(jwt_file_path, "w") as f:
-                        f.write(
-                            jwt_format(
-                                temp_list["token_status_list"],
-                                temp_list["country"],
-                                temp_list["status_list_uri"],
-                            )
-                        )
-
-                    cwt_file_path = os.path.join(dir_path, "token_status_list.cwt")
-                    with open(cwt_file_path, "wb") as f:
-                        f.write(
-                            cwt_format(
-                                temp_list["token_status_list"],
-                                temp_list["country"],
-                                temp_list["status_list_uri"],
-                            )
-                        )
-
-                elif "identifier_list" in dir_path:
-                    list_type = "identifier_list"
-
-                    shutil.copy(dir_path + "/identifier_list.jwt", copy_dir)
-                    shutil.copy(dir_path + "/identifier_list.cwt", copy_dir)
-                    shutil.copy(dir_path + "/full_list.json", copy_dir)
-
-                    jwt_file_path = os.path.join(dir_path, "identifier_list.jwt")
-                    with open(jwt_file_path, "w") as f:
-                        f.write(
-                            identifier_list_jwt_format(
-                                temp_list["identifier_list"],
-                                temp_list["country"],
-                                temp_list["identifier_list_uri"],
-                            )
-                        )
-
-                    cwt_file_path = os.path.join(dir_path, "identifier_list.cwt")
-                    with open(cwt_file_path, "wb") as f:
-                        f.write(
-                            identifier_list_cwt_format(
-                                temp_list["identifier_list"],
-                                temp_list["country"],
-                                temp_list["identifier_list_uri"],
-                            )
-                        )
-
-
-def daily_renewal():
-    while True:
-        now = datetime.now()
-
-        if now.hour < 12:
-            next_execution = now.replace(hour=12, minute=0, second=0, microsecond=0)
-        else:
-            next_execution = (now + timedelta(days=1)).replace(
-                hour=0, minute=0, second=0, microsecond=0
-            )
 
-        # next_execution = now + timedelta(minutes=1)
+def renewal_due_at(directory: str, header: dict, signature: dict) -> float:
+    """
+    Returns when a list must be signed again. Lists are renewed up to renewal_spread
+    of signature_validity early, by an offset fixed per list, so that lists signed
+    together are renewed at different times.
+
+    Args:
+        directory (str): token status list directory of the list
+        header (dict): header of the list
+        signature (dict): output of read_signature
+
+    Returns:
+        float: timestamp from which the list is due
+    """
+
+    if signature is not None:
+        signed_at = signature["signed_at"]
+    else:
+        # Lists signed by previous versions have no signature file
+        signed_at = os.path.getmtime(os.path.join(directory, "token_status_list.jwt"))
+
+    offset = uuid.UUID(header["rand"]).int % 1000 / 1000 * cfgservice.renewal_spread
+
+    return signed_at + cfgservice.signature_validity * (1 - offset)
+
+
+def renewal_needed(directory: str, header: dict, now: float) -> bool:
+    """
+    Tells whether a list is due for renewal, or changed since it was last signed
+
+    Args:
+        directory (str): token status list directory of the list
+        header (dict): header of the list
+        now (float): current timestamp
+
+    Returns:
+        bool: whether the list must be signed again
+    """
+
+    signature = read_signature(directory)
+
+    if now >= renewal_due_at(directory, header, signature):
+        return True
+
+    if signature is None:
+        return False
+
+    # Taking indexes also saves the state, only a different content is a change
+    state_modified = os.path.getmtime(os.path.join(directory, STATE_FILE))
+
+    return (
+        state_modified >= signature["signed_at"]
+        and read_content_hash(directory) != signature["content_hash"]
+    )
+
+
+def find_lists() -> list:
+    """
+    Returns the directories of the lists of status_list_dir
 
-        seconds_until_execution = (next_execution - now).total_seconds()
+    Returns:
+        list: token status list directories
+    """
 
-        cfgservice.app_logger.info(
-            f"Renewing in {int(seconds_until_execution // 3600):02}:{int((seconds_until_execution % 3600) // 60):02}:{round(seconds_until_execution % 60):02}"
+    return [
+        root
+        for root, _, files in os.walk(
+            os.path.join(cfgservice.status_list_dir, "token_status_list")
         )
+        if STATE_FILE in files or LEGACY_STATE_FILE in files
+    ]
+
+
+def list_deadline(directory: str, now: float) -> float:
+    """
+    Returns when a list must next be renewed or removed
+
+    Args:
+        directory (str): token status list directory of the list
+        now (float): current timestamp
+
+    Returns:
+        float: timestamp of the deadline, None for lists never published
+    """
+
+    migrate_list(directory)
+    header = read_list_header(directory)
+
+    if "status_list_uri" not in header or "identifier_list_uri" not in header:
+        return None
+
+    if renewal_needed(directory, header, now):
+        return now
+
+    return min(
+        renewal_due_at(directory, header, read_signature(directory)),
+        expiry_timestamp(header["expires"]),
+    )
+
+
+def check_list(directory: str, now: float, force: bool) -> str:
+    """
+    Removes a list if it expired, and tells whether it must be renewed
+
+    Args:
+        directory (str): token status list directory of the list
+        now (float): current timestamp
+        force (bool): renew the list even if its signature is fresh
+
+    Returns:
+        str: "renew", "removed" or "skipped"
+    """
+
+    migrate_list(directory)
+    header = read_list_header(directory)
+
+    if "status_list_uri" not in header or "identifier_list_uri" not in header:
+        cfgservice.app_logger.info(f"Uris don't exist: {directory}")
+        return "skipped"
+
+    # Lists still in use, with unsaved changes or owned by another process, are
+    # removed later
+    if expiry_timestamp(header["expires"]) <= now and remove_list(
+        directory, header["country"], header["doctype"]
+    ):
+        cfgservice.app_logger.info(f"Removed {directory} as it is expired.")
+        return "removed"
+
+    if not force and not renewal_needed(directory, header, now):
+        return "skipped"
+
+    return "renew"
+
+
+def _file_state(path: str) -> tuple:
+    """Returns the values used to detect a change of a file on disk"""
+    stat = os.stat(path)
+    return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+
+def backup_list(directory: str) -> dict:
+    """
+    Stores the published artifacts and the state of a list in the backup store
+
+    Args:
+        directory (str): token status list directory of the list
+
+    Returns:
+        dict: output of backup_files
+    """
+
+    identifier_dir_path = identifier_list_directory(directory)
+
+    return backup_files(
+        [
+            os.path.join(directory, "token_status_list.jwt"),
+            os.path.join(directory, "token_status_list.cwt"),
+            os.path.join(directory, STATE_FILE),
+            os.path.join(identifier_dir_path, "identifier_list.jwt"),
+            os.path.join(identifier_dir_path, "identifier_list.cwt"),
+        ]
+    )
+
+
+def sign_renewal(directory: str) -> tuple:
+    """
+    Backs up a list and signs it again from its saved state. Runs in the renewal
+    workers, which may be separate processes, so nothing is written but the backup.
+
+    Args:
+        directory (str): token status list directory of the list
+
+    Returns:
+        tuple: state of the list file that was signed, country, doctype, the signed
+        artifacts and the files backed up
+    """
+
+    file_state = _file_state(os.path.join(directory, STATE_FILE))
+    temp_list = read_list_state(directory)
+    country = temp_list["country"]
+    doctype = temp_list["doctype"]
+
+    backup = backup_list(directory)
+
+    return (
+        file_state,
+        country,
+        doctype,
+        sign_list(temp_list, country, doctype),
+        backup,
+    )
+
+
+def store_renewal(directory: str, renewal: tuple):
+    """
+    Writes the artifacts signed by sign_renewal, unless the list changed since they
+    were signed, in which case it is signed again from its current state
+
+    Args:
+        directory (str): token status list directory of the list
+        renewal (tuple): output of sign_renewal
+    """
+
+    file_state, country, doctype, artifacts, _ = renewal
+
+    # Status changes save the state under the same lock, so an unchanged state
+    # file means the artifacts include every change made to the list
+    with get_list_lock(country, doctype):
+        temp_list = unsaved_list(directory)
+
+        if temp_list is not None:
+            # Changes journaled but not saved yet are only in memory
+            publish_list(temp_list, country, doctype)
+        elif _file_state(os.path.join(directory, STATE_FILE)) == file_state:
+            write_artifacts(artifacts)
+        else:
+            temp_list = read_list_state(directory)
+            publish_list(temp_list, country, doctype)
 
-        time.sleep(seconds_until_execution)
 
-        cfgservice.app_logger.info("Renewing Revocation Lists")
+def renew_directories(directories: list, force: bool = False) -> dict:
+    """
+    Renews the given lists that are due or changed since they were last signed,
+    and removes the expired ones. Lists are signed in parallel by renewal_workers
+    threads or processes, and a list that fails to renew doesn't stop the renewal of
+    the others.
+
+    Args:
+        directories (list): token status list directories of the lists
+        force (bool): renew every list that hasn't expired
+
+    Returns:
+        dict: number of lists renewed, removed, skipped and failed, and duration
+    """
 
+    start = time.monotonic()
+    now = time.time()
+    snapshot = {}
+    to_renew = []
+    renewed = removed = skipped = failed = 0
+
+    for directory in directories:
         try:
-            renew_lists()
-        except Exception as e:
-            print(f"Error: {e}")
+            action = check_list(directory, now, force)
+        except Exception:
+            cfgservice.app_logger.error(
+                f"An error occurred while processing the list: {directory}",
+                exc_info=True,
+            )
+            failed += 1
+            continue
+
+        if action == "renew":
+            to_renew.append(directory)
+        elif action == "removed":
+            removed += 1
+        else:
+            skipped += 1
+
+    executor_class = (
+        ProcessPoolExecutor
+        if cfgservice.renewal_executor == "process"
+        else ThreadPoolExecutor
+    )
+
+    # Blobs stored by the workers aren't pruned until the manifest using them is
+    # written
+    with backup_lock(), executor_class(
+        max_workers=cfgservice.renewal_workers
+    ) as executor:
+        futures = {
+            executor.submit(sign_renewal, directory): directory
+            for directory in to_renew
+        }
+
+        for future in as_completed(futures):
+            directory = futures[future]
+            try:
+                renewal = future.result()
+                snapshot.update(renewal[4])
+                store_renewal(directory, renewal)
+                renewed += 1
+            except Exception:
+                cfgservice.app_logger.error(
+                    f"Failed to renew the list: {directory}", exc_info=True
+                )
+                failed += 1
+
+        if snapshot:
+            write_snapshot(
+                datetime.now().strftime(SNAPSHOT_FORMAT), complete_snapshot(snapshot)
+            )
+
+    prune_backups_if_due()
+
+    summary = {
+        "renewed": renewed,
+        "removed": removed,
+        "skipped": skipped,
+        "failed": failed,
+        "seconds": round(time.monotonic() - start, 3),
+    }
+
+    for result in ("renewed", "removed", "skipped", "failed"):
+        if summary[result]:
+            metrics.increment("renewal_lists_total", summary[result], result=result)
+    metrics.observe("renewal_duration_seconds", time.monotonic() - start)
+
+    # Most runs find nothing to do
+    log = cfgservice.app_logger.info
+    if not (renewed or removed or failed):
+        log = cfgservice.app_logger.debug
+
+    log(
+        f"Renewed {renewed} lists, removed {removed}, skipped {skipped}, "
+        f"failed {failed} in {summary['seconds']}s"
+    )
+
+    return summary
+
+
+def renew_lists(force: bool = False) -> dict:
+    """
+    Renews every list of status_list_dir that is due or changed, and removes the
+    expired ones
+
+    Args:
+        force (bool): renew every list that hasn't expired
+
+    Returns:
+        dict: output of renew_directories
+    """
 
+    # Status changes still waiting to be published are signed first
+    flush_lists()
 
-def start_renewal_thread():
-    task_thread = threading.Thread(target=daily_renewal, daemon=True)
-    task_thread.start()
+    return renew_directories(find_lists(), force)
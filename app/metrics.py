@@ -0,0 +1,283 @@
+# coding: latin-1
+###############################################################################
+# Copyright (c) 2023 European Commission
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+###############################################################################
+"""
+Counters, gauges and histograms of the service, exposed on /metrics in the
+Prometheus text format.
+
+Metrics are kept per process. Values computed from the state of the service, such
+as fill ratios, are collected when /metrics is requested, by the functions
+registered with register_collector.
+"""
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+from flask import Response, g, request
+
+PREFIX = "tsl_"
+
+# Upper bounds of the histogram buckets, in seconds
+BUCKETS = (
+    0.0001,
+    0.00025,
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+    30,
+    60,
+)
+
+# Values by metric name, then by labels as a tuple of (name, value) pairs
+counters = {}
+gauges = {}
+
+# Histograms as [count per bucket (the last one for +Inf), sum] by name and labels
+histograms = {}
+
+# Help text by metric name
+descriptions = {}
+
+metrics_lock = threading.Lock()
+
+
+def _reset_metrics_lock():
+    """Renewal worker processes are forked while the lock may be held"""
+    global metrics_lock
+    metrics_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_metrics_lock)
+
+# Functions returning (name, labels, value) gauge samples when metrics are rendered
+collectors = []
+
+
+def describe(name: str, text: str):
+    """
+    Sets the help text of a metric
+
+    Args:
+        name (str): name of the metric, without prefix
+        text (str): description
+    """
+
+    descriptions[name] = text
+
+
+def increment(name: str, value: float = 1, **labels):
+    """
+    Increases a counter
+
+    Args:
+        name (str): name of the counter, without prefix
+        value (float): increment
+        labels: labels of the sample
+    """
+
+    key = tuple(sorted(labels.items()))
+
+    with metrics_lock:
+        samples = counters.setdefault(name, {})
+        samples[key] = samples.get(key, 0) + value
+
+
+def set_gauge(name: str, value: float, **labels):
+    """
+    Sets a gauge
+
+    Args:
+        name (str): name of the gauge, without prefix
+        value (float): value
+        labels: labels of the sample
+    """
+
+    with metrics_lock:
+        gauges.setdefault(name, {})[tuple(sorted(labels.items()))] = value
+
+
+def observe(name: str, value: float, **labels):
+    """
+    Records a value, usually a duration in seconds, in a histogram
+
+    Args:
+        name (str): name of the histogram, without prefix
+        value (float): observed value
+        labels: labels of the sample
+    """
+
+    key = tuple(sorted(labels.items()))
+    bucket = bisect_left(BUCKETS, value)
+
+    with metrics_lock:
+        samples = histograms.setdefault(name, {})
+        histogram = samples.get(key)
+        if histogram is None:
+            histogram = samples[key] = [[0] * (len(BUCKETS) + 1), 0.0]
+
+        histogram[0][bucket] += 1
+        histogram[1] += value
+
+
+@contextmanager
+def timed(name: str, **labels):
+    """
+    Records the duration of a block in a histogram
+
+    Args:
+        name (str): name of the histogram, without prefix
+        labels: labels of the sample
+    """
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start, **labels)
+
+
+def register_collector(collector):
+    """
+    Adds a function called when metrics are rendered
+
+    Args:
+        collector (callable): function returning (name, labels, value) samples
+    """
+
+    collectors.append(collector)
+
+
+def _format_labels(labels, extra: tuple = ()) -> str:
+    """Formats labels as {name="value",...}"""
+    pairs = list(labels) + list(extra)
+
+    if not pairs:
+        return ""
+
+    return (
+        "{"
+        + ",".join(
+            '{}="{}"'.format(
+                name,
+                str(value)
+                .replace("\\", "\\\\")
+                .replace('"', '\\"')
+                .replace("\n", "\\n"),
+            )
+            for name, value in pairs
+        )
+        + "}"
+    )
+
+
+def render() -> str:
+    """
+    Renders every metric in the Prometheus text format
+
+    Returns:
+        str: the metrics
+    """
+
+    collected = {}
+    for collector in collectors:
+        for name, labels, value in collector():
+            collected.setdefault(name, {})[tuple(sorted(labels.items()))] = value
+
+    lines = []
+
+    with metrics_lock:
+        families = [
+            ("counter", counters),
+            ("gauge", {**gauges, **collected}),
+            ("histogram", histograms),
+        ]
+
+        for kind, metrics in families:
+            for name in sorted(metrics):
+                full_name = PREFIX + name
+
+                if name in descriptions:
+                    lines.append(f"# HELP {full_name} {descriptions[name]}")
+                lines.append(f"# TYPE {full_name} {kind}")
+
+                for labels, value in sorted(metrics[name].items()):
+                    if kind != "histogram":
+                        lines.append(f"{full_name}{_format_labels(labels)} {value}")
+                        continue
+
+                    buckets, total = value
+                    cumulative = 0
+                    for bound, count in zip(BUCKETS + ("+Inf",), buckets):
+                        cumulative += count
+                        lines.append(
+                            f"{full_name}_bucket"
+                            f"{_format_labels(labels, (('le', bound),))} {cumulative}"
+                        )
+                    lines.append(f"{full_name}_sum{_format_labels(labels)} {total}")
+                    lines.append(
+                        f"{full_name}_count{_format_labels(labels)} {cumulative}"
+                    )
+
+    return "\n".join(lines) + "\n"
+
+
+def init_app(app):
+    """
+    Times every request of an application and adds the /metrics endpoint
+
+    Args:
+        app (Flask): the application
+    """
+
+    @app.before_request
+    def start_timer():
+        g.request_start = time.perf_counter()
+
+    @app.after_request
+    def record_request(response):
+        start = g.pop("request_start", None)
+
+        if start is not None:
+            observe(
+                "request_duration_seconds",
+                time.perf_counter() - start,
+                endpoint=request.endpoint or "unknown",
+                method=request.method,
+                status=response.status_code,
+            )
+
+        return response
+
+    @app.route("/metrics", methods=["GET"])
+    def metrics():
+        return Response(render(), mimetype="text/plain; version=0.0.4")
+
+
+describe("request_duration_seconds", "Duration of the HTTP requests, by endpoint")
@@ -0,0 +1,252 @@
+# coding: latin-1
+###############################################################################
+# Copyright (c) 2023 European Commission
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+###############################################################################
+"""
+Scheduling of the list renewals.
+
+Only one process renews the lists on schedule: the one holding an exclusive lock
+on status_list_dir/renewal.lock. The others retry every renewal_interval, and take
+over when the leader exits. The leader keeps the deadline of every list in a
+priority queue, rebuilt from disk every renewal_interval, and sleeps until the
+earliest one.
+"""
+import fcntl
+import heapq
+import os
+import threading
+import time
+
+from app import metrics
+from app.config_service import ConfService as cfgservice
+from app.list_publisher import flush_lists
+from app.lists_renewal import find_lists, list_deadline, renew_directories
+
+LOCK_FILE = "renewal.lock"
+
+# Deadlines of the lists, as (timestamp, token status list directory)
+deadlines = []
+
+deadlines_lock = threading.Lock()
+
+# Set to wake up the scheduler before its next deadline
+wakeup = threading.Event()
+
+# Open lock file while this process is the renewal leader
+leader_lock_file = None
+
+
+def acquire_leadership() -> bool:
+    """
+    Tries to become the process renewing the lists
+
+    Returns:
+        bool: whether this process is the leader
+    """
+
+    global leader_lock_file
+
+    if leader_lock_file is not None:
+        return True
+
+    os.makedirs(cfgservice.status_list_dir, exist_ok=True)
+    lock_file = open(os.path.join(cfgservice.status_list_dir, LOCK_FILE), "a")
+
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        lock_file.close()
+        return False
+
+    leader_lock_file = lock_file
+    cfgservice.app_logger.info(f"Process {os.getpid()} is the renewal leader")
+
+    return True
+
+
+def schedule(directory: str, not_before: float = None):
+    """
+    Adds the next deadline of a list to the queue
+
+    Args:
+        directory (str): token status list directory of the list
+        not_before (float): earliest deadline, to retry lists that failed to renew
+        later rather than immediately
+    """
+
+    now = time.time()
+    deadline = list_deadline(directory, now)
+
+    if deadline is None:
+        return
+
+    deadline = max(deadline, not_before or now)
+
+    with deadlines_lock:
+        earliest = not deadlines or deadline < deadlines[0][0]
+        heapq.heappush(deadlines, (deadline, directory))
+
+    if earliest:
+        wakeup.set()
+
+
+def collect_scheduler_metrics():
+    """
+    Returns the length of the renewal queue, collected when metrics are rendered
+
+    Returns:
+        list: (name, labels, value) samples
+    """
+
+    with deadlines_lock:
+        return [("lists_scheduled", {}, len(deadlines))]
+
+
+metrics.register_collector(collect_scheduler_metrics)
+
+
+def schedule_all() -> int:
+    """
+    Rebuilds the queue from the lists on disk
+
+    Returns:
+        int: number of lists scheduled
+    """
+
+    now = time.time()
+    scheduled = []
+
+    for directory in find_lists():
+        try:
+            deadline = list_deadline(directory, now)
+        except Exception:
+            cfgservice.app_logger.error(
+                f"An error occurred while processing the list: {directory}",
+                exc_info=True,
+            )
+            continue
+
+        if deadline is not None:
+            scheduled.append((deadline, directory))
+
+    heapq.heapify(scheduled)
+
+    with deadlines_lock:
+        deadlines[:] = scheduled
+
+    return len(scheduled)
+
+
+def next_deadline() -> float:
+    """
+    Returns the earliest deadline of the queue
+
+    Returns:
+        float: timestamp, None if the queue is empty
+    """
+
+    with deadlines_lock:
+        return deadlines[0][0] if deadlines else None
+
+
+def run_due_lists(now: float) -> dict:
+    """
+    Renews or removes the lists whose deadline passed, and schedules them again
+
+    Args:
+        now (float): current timestamp
+
+    Returns:
+        dict: output of renew_directories, None if no list was due
+    """
+
+    directories = set()
+
+    with deadlines_lock:
+        while deadlines and deadlines[0][0] <= now:
+            directories.add(heapq.heappop(deadlines)[1])
+
+    directories = sorted(d for d in directories if os.path.isdir(d))
+
+    if not directories:
+        return None
+
+    flush_lists()
+    summary = renew_directories(directories)
+
+    for directory in directories:
+        if os.path.isdir(directory):
+            try:
+                schedule(directory, now + cfgservice.renewal_interval)
+            except Exception:
+                cfgservice.app_logger.error(
+                    f"Failed to schedule the list: {directory}", exc_info=True
+                )
+
+    return summary
+
+
+def renew_list_now(directory: str) -> dict:
+    """
+    Renews a list immediately, whatever its deadline, from any process
+
+    Args:
+        directory (str): token status list directory of the list
+
+    Returns:
+        dict: output of renew_directories
+    """
+
+    flush_lists()
+    summary = renew_directories([directory], force=True)
+
+    if os.path.isdir(directory):
+        schedule(directory)
+
+    return summary
+
+
+def run_scheduler():
+    next_scan = 0
+
+    while True:
+        timeout = cfgservice.renewal_interval
+
+        try:
+            if acquire_leadership():
+                now = time.time()
+
+                if now >= next_scan:
+                    schedule_all()
+                    next_scan = now + cfgservice.renewal_interval
+
+                run_due_lists(now)
+
+                deadline = next_deadline()
+                if deadline is not None:
+                    timeout = min(deadline, next_scan) - time.time()
+                else:
+                    timeout = next_scan - time.time()
+        except Exception:
+            cfgservice.app_logger.error("Renewal failed", exc_info=True)
+
+        wakeup.wait(max(timeout, 0))
+        wakeup.clear()
+
+
+def start_renewal_scheduler():
+    task_thread = threading.Thread(target=run_scheduler, daemon=True)
+    task_thread.start()
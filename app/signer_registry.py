@@ -0,0 +1,137 @@
+# coding: latin-1
+###############################################################################
+# Copyright (c) 2023 European Commission
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+###############################################################################
+import base64
+import os
+import threading
+
+from cryptography import x509
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import serialization
+from app import metrics
+from app.config_service import ConfService as cfgservice
+
+
+class CountrySigner:
+    """
+    Signing material of a country, parsed once and kept in memory.
+
+    Attributes:
+        private_key: parsed private key used to sign the lists
+        cert_der (bytes): DER encoded certificate
+        x5c (str): base64 encoded certificate, as used in the x5c JWT header
+    """
+
+    def __init__(self, private_key, cert_der: bytes, files: tuple):
+        self.private_key = private_key
+        self.cert_der = cert_der
+        self.x5c = base64.b64encode(cert_der).decode()
+        self.files = files
+
+
+_signers = {}
+
+_signers_lock = threading.Lock()
+
+
+def _reset_signers_lock():
+    """Renewal worker processes are forked while the lock may be held"""
+    global _signers_lock
+    _signers_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_signers_lock)
+
+
+def _file_state(path: str) -> tuple:
+    """
+    Returns the values used to detect a change of a file on disk
+
+    Args:
+        path (str): path of the file
+
+    Returns:
+        tuple: path, inode, modification time and size of the file
+    """
+
+    stat = os.stat(path)
+    return (path, stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+
+def _load_signer(country: str, files: tuple) -> CountrySigner:
+    """
+    Reads and parses the private key and certificate of a country
+
+    Args:
+        country (str): country code
+        files (tuple): state of the key and certificate files
+
+    Returns:
+        CountrySigner: the parsed signing material
+    """
+
+    country_config = cfgservice.countries[country]
+
+    with open(country_config["privKey"], "rb") as key_file:
+        private_key = serialization.load_pem_private_key(
+            key_file.read(),
+            password=country_config["privkey_passwd"],
+            backend=default_backend(),
+        )
+
+    with open(country_config["cert"], "rb") as file:
+        certificate = file.read()
+
+    cert = x509.load_der_x509_certificate(certificate)
+
+    cert_der = cert.public_bytes(serialization.Encoding.DER)
+
+    cfgservice.app_logger.info(f"Loaded signing key and certificate for {country}")
+
+    return CountrySigner(private_key, cert_der, files)
+
+
+def get_signer(country: str) -> CountrySigner:
+    """
+    Returns the signing material of a country, loading it from disk only on first
+    use or when the key or certificate file changed since it was loaded
+
+    Args:
+        country (str): country code
+
+    Returns:
+        CountrySigner: the parsed signing material
+    """
+
+    country_config = cfgservice.countries[country]
+    files = (
+        _file_state(country_config["privKey"]),
+        _file_state(country_config["cert"]),
+    )
+
+    signer = _signers.get(country)
+    if signer is not None and signer.files == files:
+        return signer
+
+    with _signers_lock:
+        signer = _signers.get(country)
+        if signer is None or signer.files != files:
+            with metrics.timed("signing_key_load_seconds"):
+                signer = _load_signer(country, files)
+            _signers[country] = signer
+
+    return signer
@@ -16,19 +16,27 @@
 #
 ###############################################################################
 from datetime import datetime
+import os
 from urllib.parse import unquote, urlparse
-from flask import Blueprint, current_app, jsonify, request, send_from_directory
+from uuid import UUID
+from flask import Blueprint, Response, current_app, jsonify, request, send_file, send_from_directory
 
+from app.artifact_cache import get_artifact
 from app.list_management import (
-    dump_list,
     generate_StatusListInfo,
-    load_list,
-    status_list,
-    new_list,
-    update_status_list,
+    generate_StatusListInfo_batch,
+    get_list,
+    list_directory,
+    list_state_directory,
+    set_list_statuses,
 )
+from app.list_journal import unsaved_list
+from app.list_storage import lookup_status
+from app.list_publisher import mark_dirty
+from app.renewal_scheduler import renew_list_now
 
 token = Blueprint("token_status_list", __name__, url_prefix="/token_status_list")
+identifier = Blueprint("identifier_list", __name__, url_prefix="/identifier_list")
 from app.config_service import ConfService as cfgservice
 
 def validate_doctype(user_input):
@@ -58,10 +66,73 @@ def validate_expiry_date(user_input):
     # Return clean date string from parsed date
     return parsed_date.strftime("%Y-%m-%d")
 
+def validate_count(user_input):
+    """Validate the number of indexes requested in a batch"""
+    try:
+        count = int(user_input)
+    except (ValueError, TypeError):
+        raise ValueError("Invalid count")
+
+    if count < 1 or count > cfgservice.max_batch_size:
+        raise ValueError(f"Count must be between 1 and {cfgservice.max_batch_size}.")
+
+    return count
+
+def validate_list_uri(user_input):
+    """Validate a list URI and return its country, doctype and list id"""
+    if not isinstance(user_input, str):
+        raise ValueError("Invalid URI")
+
+    path_parts = urlparse(user_input).path.split("/")
+
+    if len(path_parts) != 5 or path_parts[1] not in ("token_status_list", "identifier_list"):
+        raise ValueError("Invalid URI")
+
+    country = validate_country(path_parts[2])
+    doctype = validate_doctype(path_parts[3])
+
+    try:
+        id = str(UUID(path_parts[4]))
+    except ValueError:
+        raise ValueError("Invalid URI")
+
+    return country, doctype, id
+
+def validate_status_change(user_input):
+    """Validate one status change of a batch and return its uri, index and status"""
+    if not isinstance(user_input, dict):
+        raise ValueError("Invalid status change")
+
+    uri = user_input.get("uri")
+    index = user_input.get("id", user_input.get("idx"))
+    status = user_input.get("status")
+
+    if uri is None or index is None or status is None:
+        raise ValueError("Missing URI/index/status")
+
+    try:
+        index = int(index)
+    except (ValueError, TypeError):
+        raise ValueError("'id' or 'idx' unkown")
+
+    if index < 0:
+        raise ValueError("'id' or 'idx' unkown")
+
+    try:
+        status = int(status)
+    except (ValueError, TypeError):
+        raise ValueError("status unkown")
+
+    if status < 0:
+        raise ValueError("Wrong Status Change")
+
+    return uri, index, status
+
 @token.route("/take", methods=["POST"])
 def take_index():
 
-    cfgservice.app_logger.info("Take Request, header:\n" + str(request.headers) + ", payload:\n" + str(request.form.to_dict()))
+    # Headers are not logged, they hold the API key
+    cfgservice.app_logger.debug("Take Request, payload:\n" + str(request.form.to_dict()))
 
     api_key = request.headers.get("X-Api-Key")
 
@@ -86,14 +157,37 @@ def take_index():
     except ValueError as e:
         cfgservice.app_logger.error(str(e))
         return jsonify({"error": str(e)}), 400
-        
-    if country not in status_list:
-        new_list(country,doctype)
-    #if doctype not in status_list:
-    #    new_list(doctype)
+
     status_info = generate_StatusListInfo(country,doctype,expiry_date)
     
-    print("\nStatus Info: ", status_info, flush=True)
+    cfgservice.app_logger.debug("Status Info: " + str(status_info))
+
+    return jsonify(status_info)
+
+
+@token.route("/take_batch", methods=["POST"])
+def take_index_batch():
+
+    api_key = request.headers.get("X-Api-Key")
+
+    if api_key != current_app.config['API_key']:
+        cfgservice.app_logger.error("Incorrect API key")
+        return jsonify({"error": "Incorrect API key"}), 401
+
+    try:
+        doctype = validate_doctype(request.form.get("doctype"))
+        country = validate_country(request.form.get("country"))
+        expiry_date = validate_expiry_date(request.form.get("expiry_date"))
+        count = validate_count(request.form.get("count"))
+    except ValueError as e:
+        cfgservice.app_logger.error(str(e))
+        return jsonify({"error": str(e)}), 400
+
+    status_info = generate_StatusListInfo_batch(country, doctype, expiry_date, count)
+
+    cfgservice.app_logger.info(
+        f"Took {count} indexes for {country}/{doctype}"
+    )
 
     return jsonify(status_info)
 
@@ -101,7 +195,7 @@ def take_index():
 @token.route("/get", methods=["GET"])
 def get_index():
 
-    print("\nargs: ", request.args, flush=True)
+    cfgservice.app_logger.debug("Get Request, args: " + str(request.args))
 
     """ api_key = request.headers.get("X-Api-Key")
     if api_key != current_app.config['API_key']:
@@ -121,15 +215,36 @@ def get_index():
         return jsonify({"error": "'id' or 'idx' unkown"}), 400
 
     uri = unquote(uri)
-    temp_list = load_list(uri)
+
+    try:
+        validate_list_uri(uri)
+    except ValueError:
+        return jsonify({"error": "List not found"}), 404
+
+    directory = list_state_directory(uri)
+
+    # Lists with changes not saved yet are read from memory, by get_list
+    if "token_status_list" in uri and unsaved_list(directory) is None:
+        try:
+            return str(lookup_status(directory, index))
+        except IndexError:
+            return jsonify({"error": "'id' or 'idx' unkown"}), 400
+        except FileNotFoundError:
+            # Lists not migrated yet to the binary format
+            pass
+
+    try:
+        temp_list = get_list(uri)
+    except (OSError, ValueError):
+        return jsonify({"error": "List not found"}), 404
 
     if "token_status_list" in uri:
-        return str(temp_list["token_status_list"].status_list.get(index))
+        try:
+            return str(temp_list["token_status_list"].status_list.get(index))
+        except IndexError:
+            return jsonify({"error": "'id' or 'idx' unkown"}), 400
     elif "identifier_list" in uri:
-        if str(index) not in temp_list["identifier_list"]:
-            return str(0)
-        else:
-            return str(temp_list["identifier_list"][str(index)])
+        return str(temp_list["identifier_list"].get(index))
     else:
         return jsonify({"error": "Missing URI or index"}), 400
 
@@ -162,37 +277,185 @@ def set_index():
         cfgservice.app_logger.error(str(e))
         return jsonify({"error": " status unkown"}), 400
 
-    if status != 1:
+    # Statuses wider than the list are rejected with the list loaded
+    if status < 0:
         return jsonify({"error": "Wrong Status Change"}), 400
 
-    temp_list = load_list(uri)
-    
-    temp_list["token_status_list"].status_list.set(index, status)
-
-    temp_list["identifier_list"].update({str(index): status})
-
-    parsed_url = urlparse(uri)
-    path_parts = parsed_url.path.split("/")
-
     try:
-        doctype = validate_doctype(path_parts[3])
+        country, doctype, id = validate_list_uri(uri)
     except ValueError as e:
         cfgservice.app_logger.error(str(e))
         return jsonify({"error": str(e)}), 400
 
     try:
-        country = validate_country(path_parts[2])
+        temp_list, [error] = set_list_statuses(uri, country, doctype, id, [(index, status)])
+    except (OSError, ValueError) as e:
+        cfgservice.app_logger.error(f"Unable to load list {uri}: {e}")
+        return jsonify({"error": "List not found"}), 404
+
+    if error is not None:
+        cfgservice.app_logger.error(error)
+        return jsonify({"error": error}), 400
+
+    mark_dirty(temp_list, country, doctype)
+
+    return "Status Changed\n"
+
+
+@token.route("/set_batch", methods=["POST"])
+def set_index_batch():
+    api_key = request.headers.get("X-Api-Key")
+    if api_key != current_app.config['API_key']:
+        return jsonify({"message": "Unauthorized access"}), 401
+
+    payload = request.get_json(silent=True)
+    changes = payload.get("changes") if isinstance(payload, dict) else None
+
+    if not isinstance(changes, list) or not changes:
+        return jsonify({"error": "Missing changes"}), 400
+
+    if len(changes) > cfgservice.max_batch_size:
+        return jsonify({"error": f"At most {cfgservice.max_batch_size} changes per request"}), 400
+
+    results = [None] * len(changes)
+
+    # Changes grouped by list, so that each list is loaded and saved only once
+    changes_by_list = {}
+
+    for position, change in enumerate(changes):
+        try:
+            uri, index, status = validate_status_change(change)
+            country, doctype, id = validate_list_uri(uri)
+        except ValueError as e:
+            results[position] = {"result": "error", "error": str(e)}
+            continue
+
+        changes_by_list.setdefault((country, doctype, id), []).append(
+            (position, uri, index, status)
+        )
+
+    for (country, doctype, id), list_changes in changes_by_list.items():
+        uri = list_changes[0][1]
+
+        try:
+            temp_list, errors = set_list_statuses(
+                uri, country, doctype, id,
+                [(index, status) for _, _, index, status in list_changes],
+            )
+        except (OSError, ValueError) as e:
+            cfgservice.app_logger.error(f"Unable to load list {uri}: {e}")
+            for position, uri, index, status in list_changes:
+                results[position] = {"uri": uri, "idx": index, "result": "error", "error": "List not found"}
+            continue
+
+        for (position, uri, index, status), error in zip(list_changes, errors):
+            if error is None:
+                results[position] = {"uri": uri, "idx": index, "status": status, "result": "Status Changed"}
+            else:
+                results[position] = {"uri": uri, "idx": index, "result": "error", "error": error}
+
+        if None in errors:
+            mark_dirty(temp_list, country, doctype)
+
+    cfgservice.app_logger.info(
+        f"Batch status change: {len(changes)} changes over {len(changes_by_list)} lists"
+    )
+
+    return jsonify({"results": results})
+
+
+@token.route("/renew", methods=["POST"])
+def renew_list():
+    api_key = request.headers.get("X-Api-Key")
+    if api_key != current_app.config['API_key']:
+        return jsonify({"message": "Unauthorized access"}), 401
+
+    uri = request.form.get("uri")
+
+    if uri is None:
+        return jsonify({"error": "Missing URI"}), 400
+
+    try:
+        validate_list_uri(uri)
     except ValueError as e:
         cfgservice.app_logger.error(str(e))
         return jsonify({"error": str(e)}), 400
-    
-    id = path_parts[4]
 
-    update_status_list(country,doctype,id, index)
+    directory = list_state_directory(uri)
 
-    dump_list(temp_list, country, doctype)
+    if not os.path.isdir(directory):
+        return jsonify({"error": "List not found"}), 404
 
-    return "Status Changed\n"
+    summary = renew_list_now(directory)
+
+    if summary["failed"]:
+        return jsonify({"error": "Renewal failed", **summary}), 500
+
+    return jsonify(summary)
+
+
+# Media types of the signed artifacts of each list type, JWT first as the default
+ARTIFACT_MEDIA_TYPES = {
+    "token_status_list": ["application/statuslist+jwt", "application/statuslist+cwt"],
+    "identifier_list": ["application/identifierlist+jwt", "application/identifierlist+cwt"],
+}
+
+def serve_artifact(list_type, country, doctype, rand):
+    """Serve the signed JWT or CWT of a list, as negotiated with the Accept header"""
+    try:
+        country = validate_country(country)
+        doctype = validate_doctype(doctype)
+        rand = str(UUID(rand))
+    except ValueError:
+        return jsonify({"error": "List not found"}), 404
+
+    media_types = ARTIFACT_MEDIA_TYPES[list_type]
+
+    if request.accept_mimetypes:
+        media_type = request.accept_mimetypes.best_match(media_types)
+        if media_type is None:
+            return jsonify({"error": "Acceptable media types: " + ", ".join(media_types)}), 406
+    else:
+        media_type = media_types[0]
+
+    path = os.path.join(
+        list_directory(list_type, country, doctype, rand),
+        f"{list_type}.{media_type.rsplit('+', 1)[1]}",
+    )
+
+    try:
+        etag, data, file = get_artifact(path)
+    except FileNotFoundError:
+        return jsonify({"error": "List not found"}), 404
+
+    if data is not None:
+        response = Response(data, mimetype=media_type)
+    else:
+        # Large artifacts are streamed from disk, with sendfile when the server supports it
+        response = send_file(file, mimetype=media_type, conditional=False, etag=False)
+        response.content_length = os.fstat(file.fileno()).st_size
+
+    response.set_etag(etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = cfgservice.list_ttl
+    response.vary.add("Accept")
+
+    response = response.make_conditional(request)
+
+    if file is not None and response.status_code == 304:
+        file.close()
+
+    return response
+
+
+@token.route("/<country>/<doctype>/<rand>", methods=["GET"])
+def get_token_status_list(country, doctype, rand):
+    return serve_artifact("token_status_list", country, doctype, rand)
+
+
+@identifier.route("/<country>/<doctype>/<rand>", methods=["GET"])
+def get_identifier_list(country, doctype, rand):
+    return serve_artifact("identifier_list", country, doctype, rand)
 
 
 @token.route("/static/swagger.json")
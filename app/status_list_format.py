@@ -22,48 +22,47 @@ import time
 from cryptography.hazmat.primitives.asymmetric import ec
 from cryptography.hazmat.primitives import hashes
 from token_status_list import IssuerStatusList
-from cryptography.hazmat.primitives import serialization
-from cryptography.hazmat.backends import default_backend
-from cryptography import x509
 from app.config_service import ConfService as cfgservice
+from app import metrics
+from app.signer_registry import get_signer
 
 
-def jwt_format(token_status_list: IssuerStatusList, country: str, list_url: str) -> str:
+def compress_status_list(token_status_list: IssuerStatusList) -> bytes:
     """
-    Issues a token status list in JWT format
+    Compresses the bitstring of a token status list, as published in both formats
 
     Args:
-        token_status_list (IssuerStatusList): an instance of the IssuerStatusList class containing the token status information
+        token_status_list (IssuerStatusList): the token status list
 
     Returns:
-        str: The encoded JWT
+        bytes: the zlib compressed bitstring
     """
 
-    # private_key = ec.generate_private_key(ec.SECP256R1())
-
-    with open(cfgservice.countries[country]["privKey"], "rb") as key_file:
-        private_key = serialization.load_pem_private_key(
-            key_file.read(),
-            password=(
-                cfgservice.countries[country]["privkey_passwd"]
-                if cfgservice.countries[country]["privkey_passwd"] is not None
-                else None
-            ),
-            backend=default_backend(),
-        )
+    with metrics.timed("compression_seconds"):
+        return token_status_list.status_list.compressed()
 
-    # print("\ntoken_status_list: ", token_status_list, flush=True)
 
-    with open(cfgservice.countries[country]["cert"], "rb") as file:
-        certificate = file.read()
+def jwt_format(
+    token_status_list: IssuerStatusList,
+    country: str,
+    list_url: str,
+    compressed: bytes = None,
+) -> str:
+    """
+    Issues a token status list in JWT format
 
-    cert = x509.load_der_x509_certificate(certificate)
+    Args:
+        token_status_list (IssuerStatusList): an instance of the IssuerStatusList class containing the token status information
+        compressed (bytes): output of compress_status_list, computed if not given
 
-    _cert = cert.public_bytes(getattr(serialization.Encoding, "DER"))
+    Returns:
+        str: The encoded JWT
+    """
 
-    _cert_b64 = base64.b64encode(_cert).decode()
+    signer = get_signer(country)
 
-    print("\ncert_b64", _cert_b64, flush=True)
+    if compressed is None:
+        compressed = compress_status_list(token_status_list)
 
     payload = {
         # "iss": "https://dev.issuer.eudiw.dev",
@@ -71,70 +70,66 @@ def jwt_format(token_status_list: IssuerStatusList, country: str, list_url: str)
         "iat": int(time.time()),
         # "exp": datetime.now() + timedelta(days=1),
         "status_list": {
-            "bits": 1,
-            "lst": base64.urlsafe_b64encode(token_status_list.status_list.compressed())
-            .decode("utf-8")
-            .rstrip("="),
+            "bits": token_status_list.status_list.bits,
+            "lst": base64.urlsafe_b64encode(compressed).decode("utf-8").rstrip("="),
         },
     }
 
-    headers = {"typ": "statuslist+jwt", "x5c": [_cert_b64]}
+    headers = {"typ": "statuslist+jwt", "x5c": [signer.x5c]}
 
-    signed_jwt = jwt.encode(payload, private_key, algorithm="ES256", headers=headers)
+    # Encoding and signing, which pyjwt doesn't expose separately
+    with metrics.timed("jwt_encode_seconds", list="token_status_list"):
+        signed_jwt = jwt.encode(
+            payload, signer.private_key, algorithm="ES256", headers=headers
+        )
 
     return signed_jwt
 
 
 def cwt_format(
-    token_status_list: IssuerStatusList, country: str, list_url: str
+    token_status_list: IssuerStatusList,
+    country: str,
+    list_url: str,
+    compressed: bytes = None,
 ) -> bytes:
     """
     Issues a token status list in CWT format
 
     Args:
         token_status_list (IssuerStatusList): an instance of the IssuerStatusList class containing the token status information
+        compressed (bytes): output of compress_status_list, computed if not given
 
     Returns:
         str: The encoded CWT
     """
-    # private_key = ec.generate_private_key(ec.SECP256R1())
-
-    with open(cfgservice.countries[country]["privKey"], "rb") as key_file:
-        private_key = serialization.load_pem_private_key(
-            key_file.read(),
-            password=(
-                cfgservice.countries[country]["privkey_passwd"]
-                if cfgservice.countries[country]["privkey_passwd"] is not None
-                else None
-            ),
-            backend=default_backend(),
-        )
-
-    with open(cfgservice.countries[country]["cert"], "rb") as file:
-        certificate = file.read()
-
-    cert = x509.load_der_x509_certificate(certificate)
-
-    _cert = cert.public_bytes(getattr(serialization.Encoding, "DER"))
+    signer = get_signer(country)
 
     unprotected = {4: b"1"}
-    protected = {1: -7, 16: "application/statuslist+cwt", 33: _cert}
+    protected = {1: -7, 16: "application/statuslist+cwt", 33: signer.cert_der}
+
+    if compressed is None:
+        compressed = compress_status_list(token_status_list)
 
     claims = {
         # 1: "issuer_example",
         2: list_url,
         6: int(time.time()),
         # 4: int((datetime.now() + timedelta(days=1)).timestamp()),
-        65534: 3600,
-        65533: {"bits": 1, "lst": token_status_list.status_list.compressed()},
+        65534: cfgservice.list_ttl,
+        65533: {
+            "bits": token_status_list.status_list.bits,
+            "lst": compressed,
+        },
     }
 
-    cbor_header = cbor2.dumps(protected)
-    cbor_claims = cbor2.dumps(claims)
+    with metrics.timed("cbor_encode_seconds", list="token_status_list"):
+        cbor_header = cbor2.dumps(protected)
+        cbor_claims = cbor2.dumps(claims)
 
     message = cbor_header + cbor_claims
 
-    signature = private_key.sign(message, ec.ECDSA(hashes.SHA256()))
+    with metrics.timed("ecdsa_sign_seconds", list="token_status_list"):
+        signature = signer.private_key.sign(message, ec.ECDSA(hashes.SHA256()))
 
     cose_sign1 = [cbor_header, unprotected, cbor_claims, signature]
     tagged = cbor2.CBORTag(18, cose_sign1)
@@ -146,3 +141,18 @@ def cwt_format(
         print("CWT signature is invalid.") """
 
     return cbor2.dumps(tagged)
+
+
+def cwt_compressed_list(cwt: bytes) -> bytes:
+    """
+    Returns the compressed bitstring published in a CWT issued by cwt_format
+
+    Args:
+        cwt (bytes): the encoded CWT
+
+    Returns:
+        bytes: the zlib compressed bitstring
+    """
+
+    cbor_claims = cbor2.loads(cwt).value[2]
+    return cbor2.loads(cbor_claims)[65533]["lst"]
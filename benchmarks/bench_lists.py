@@ -0,0 +1,438 @@
+# coding: latin-1
+###############################################################################
+# Copyright (c) 2023 European Commission
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+###############################################################################
+"""
+Offline benchmarks of index allocation, signing, persistence, lookups and renewal.
+
+Run from the root of the repository:
+
+    python -m benchmarks.bench_lists --output results.json
+    python -m benchmarks.bench_lists --baseline results.json
+
+Every benchmark records the duration of each operation, summarized in seconds.
+With --baseline, medians are compared with a previous run, and the command exits
+with status 1 when one is slower by more than --tolerance.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import time
+from datetime import datetime
+
+from benchmarks import environment
+from benchmarks.environment import API_KEY, COUNTRY, DOCTYPE
+
+# Doctypes of the synthetic lists, so that each benchmark uses its own lists
+DOCTYPES = sorted(
+    [
+        "eu.europa.ec.eudi.cor.1",
+        "eu.europa.ec.eudi.ehic.1",
+        "eu.europa.ec.eudi.hiid.1",
+        "eu.europa.ec.eudi.iban.1",
+        "eu.europa.ec.eudi.loyalty.1",
+        "eu.europa.ec.eudi.msisdn.1",
+        "eu.europa.ec.eudi.pda1.1",
+        "eu.europa.ec.eudi.por.1",
+        "eu.europa.ec.eudi.tax.1",
+        "org.iso.18013.5.1.mDL",
+    ]
+)
+
+
+def summarize(durations: list, **extra) -> dict:
+    """
+    Summarizes the durations of an operation
+
+    Args:
+        durations (list): duration of each run, in seconds
+        extra: additional values recorded with the summary
+
+    Returns:
+        dict: number of runs, throughput and duration statistics
+    """
+
+    ordered = sorted(durations)
+    total = sum(ordered)
+
+    return {
+        "runs": len(ordered),
+        "per_second": round(len(ordered) / total, 1) if total else None,
+        "mean": total / len(ordered),
+        "median": statistics.median(ordered),
+        "p95": ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))],
+        "min": ordered[0],
+        "max": ordered[-1],
+        **extra,
+    }
+
+
+def measure(function, runs: int) -> list:
+    """
+    Calls a function several times, after a first call not measured, which loads
+    keys and creates lists
+
+    Args:
+        function (callable): function called without arguments
+        runs (int): number of measured calls
+
+    Returns:
+        list: duration of each call, in seconds
+    """
+
+    function()
+    durations = []
+
+    for _ in range(runs):
+        start = time.perf_counter()
+        function()
+        durations.append(time.perf_counter() - start)
+
+    return durations
+
+
+def synthetic_list(size: int, fill: float, revoked: float, rng: random.Random):
+    """
+    Creates a list with a fraction of its indexes taken, some of them revoked
+
+    Args:
+        size (int): number of indexes of the list
+        fill (float): fraction of the indexes taken
+        revoked (float): fraction of the taken indexes with status 1
+        rng (random.Random): source of the random indexes
+
+    Returns:
+        dict: the list, not registered as a current list
+    """
+
+    from app.config_service import ConfService as cfgservice
+    from app.list_management import new_list
+
+    cfgservice.token_status_list_sizes[(COUNTRY, DOCTYPE)] = size
+    specific_status_list = new_list(COUNTRY, DOCTYPE, "2099-01-01", register=False)
+    del cfgservice.token_status_list_sizes[(COUNTRY, DOCTYPE)]
+
+    token_status_list = specific_status_list["token_status_list"]
+    allocator = token_status_list.allocator
+    taken = rng.sample(range(size), int(size * fill))
+
+    # Allocated directly, taking indexes one by one gets slow on full lists
+    for index in taken:
+        allocator.allocated[index] = 1
+    allocator.num_allocated = len(taken)
+
+    for index in taken[: int(len(taken) * revoked)]:
+        token_status_list.status_list[index] = 1
+        specific_status_list["identifier_list"].set(index, 1)
+
+    return specific_status_list
+
+
+def bench_take(args) -> dict:
+    """Throughput of take_index_list on the current list of a country and doctype"""
+    from app.list_management import take_index_list
+
+    return {
+        "take_index_list": summarize(
+            measure(lambda: take_index_list(COUNTRY, DOCTYPE, "2099-01-01"), args.takes)
+        )
+    }
+
+
+def bench_formats(args, rng: random.Random) -> dict:
+    """Cost of signing and dumping lists of different sizes and fill ratios"""
+    from app.list_management import dump_list
+    from app.status_list_format import cwt_format, jwt_format
+
+    results = {}
+    uri = "https://benchmark/token_status_list"
+
+    for size in args.sizes:
+        for fill in args.fills:
+            specific_status_list = synthetic_list(size, fill, args.revoked, rng)
+            token_status_list = specific_status_list["token_status_list"]
+            parameters = {"size": size, "fill": fill}
+            suffix = f"[size={size},fill={fill}]"
+
+            results["jwt_format" + suffix] = summarize(
+                measure(lambda: jwt_format(token_status_list, COUNTRY, uri), args.runs),
+                compressed_bytes=len(token_status_list.status_list.compressed()),
+                **parameters,
+            )
+            results["cwt_format" + suffix] = summarize(
+                measure(lambda: cwt_format(token_status_list, COUNTRY, uri), args.runs),
+                **parameters,
+            )
+
+            def revoke_and_dump():
+                token_status_list.status_list[rng.randrange(size)] = 1
+                dump_list(specific_status_list, COUNTRY, DOCTYPE)
+
+            # Lists are dumped after a change, unchanged lists aren't compressed
+            results["dump_list" + suffix] = summarize(
+                measure(revoke_and_dump, args.runs), **parameters
+            )
+            results["dump_list[unchanged]" + suffix] = summarize(
+                measure(
+                    lambda: dump_list(specific_status_list, COUNTRY, DOCTYPE),
+                    args.runs,
+                ),
+                **parameters,
+            )
+
+    return results
+
+
+def bench_lookups(args, client, rng: random.Random) -> dict:
+    """Latency of load_list and /get, on saved lists"""
+    from app.config_service import ConfService as cfgservice
+    from app.list_management import checkpoint_lists, load_list
+
+    cfgservice.token_status_list_sizes[(COUNTRY, DOCTYPES[0])] = max(args.sizes)
+
+    taken = client.post(
+        "/token_status_list/take_batch",
+        data={
+            "country": COUNTRY,
+            "doctype": DOCTYPES[0],
+            "expiry_date": "2099-01-01",
+            "count": 100,
+        },
+        headers={"X-Api-Key": API_KEY},
+    ).json
+
+    # Lists with journaled changes are read from memory, checkpointed they are
+    # read from disk as in a worker that didn't take the indexes
+    checkpoint_lists()
+
+    status_list_uri = taken[0]["status_list"]["uri"]
+    identifier_list_uri = taken[0]["identifier_list"]["uri"]
+
+    def get(uri):
+        response = client.get(
+            "/token_status_list/get",
+            query_string={"uri": uri, "idx": rng.choice(taken)["status_list"]["idx"]},
+        )
+        assert response.status_code == 200, response.data
+
+    return {
+        "load_list": summarize(
+            measure(lambda: load_list(status_list_uri), args.runs),
+            size=len(load_list(status_list_uri)["token_status_list"].status_list),
+        ),
+        "get[token_status_list]": summarize(
+            measure(lambda: get(status_list_uri), args.lookups)
+        ),
+        "get[identifier_list]": summarize(
+            measure(lambda: get(identifier_list_uri), args.lookups)
+        ),
+    }
+
+
+def bench_set(args, client) -> dict:
+    """Latency of /set and of /set_batch with batch_size changes"""
+    from app.config_service import ConfService as cfgservice
+
+    headers = {"X-Api-Key": API_KEY}
+
+    # One index per /set and batch_size per /set_batch, with the calls not measured
+    needed = (args.runs + 1) * (args.batch_size + 1)
+    taken = []
+
+    while len(taken) < needed:
+        taken += client.post(
+            "/token_status_list/take_batch",
+            data={
+                "country": COUNTRY,
+                "doctype": DOCTYPES[1],
+                "expiry_date": "2099-01-01",
+                "count": min(needed - len(taken), cfgservice.max_batch_size),
+            },
+            headers=headers,
+        ).json
+
+    changes = iter(taken)
+
+    def set_one():
+        info = next(changes)["status_list"]
+        response = client.post(
+            "/token_status_list/set",
+            data={"uri": info["uri"], "idx": info["idx"], "status": 1},
+            headers=headers,
+        )
+        assert response.status_code == 200, response.data
+
+    def set_batch():
+        batch = [next(changes)["status_list"] for _ in range(args.batch_size)]
+        response = client.post(
+            "/token_status_list/set_batch",
+            json={
+                "changes": [
+                    {"uri": info["uri"], "idx": info["idx"], "status": 1}
+                    for info in batch
+                ]
+            },
+            headers=headers,
+        )
+        assert response.status_code == 200, response.data
+
+    return {
+        "set": summarize(measure(set_one, args.runs)),
+        "set_batch": summarize(
+            measure(set_batch, args.runs), batch_size=args.batch_size
+        ),
+    }
+
+
+def bench_renewal(args, rng: random.Random) -> dict:
+    """Duration of renew_lists over renewal_lists synthetic lists"""
+    from app.list_management import dump_list
+    from app.lists_renewal import renew_lists
+
+    for position in range(args.renewal_lists):
+        specific_status_list = synthetic_list(
+            args.renewal_size, args.fills[0], args.revoked, rng
+        )
+        dump_list(
+            specific_status_list, COUNTRY, DOCTYPES[2 + position % (len(DOCTYPES) - 2)]
+        )
+
+    forced = measure(lambda: renew_lists(force=True), args.renewal_runs)
+    checked = measure(lambda: renew_lists(), args.renewal_runs)
+
+    parameters = {"lists": args.renewal_lists, "size": args.renewal_size}
+
+    return {
+        "renew_lists[force]": summarize(forced, **parameters),
+        "renew_lists[unchanged]": summarize(checked, **parameters),
+    }
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list:
+    """
+    Compares the medians of two runs
+
+    Args:
+        results (dict): results of this run
+        baseline (dict): results of the previous run
+        tolerance (float): accepted slowdown, as a fraction of the previous median
+
+    Returns:
+        list: names of the benchmarks slower than the tolerance
+    """
+
+    regressions = []
+
+    for name, result in sorted(results.items()):
+        previous = baseline.get(name)
+        if previous is None:
+            continue
+
+        change = result["median"] / previous["median"] - 1
+        flag = ""
+        if change > tolerance:
+            regressions.append(name)
+            flag = "  REGRESSION"
+
+        print(
+            f"{name:60} {previous['median'] * 1000:10.3f}ms -> "
+            f"{result['median'] * 1000:10.3f}ms {change:+7.1%}{flag}"
+        )
+
+    return regressions
+
+
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("--output", help="file where the results are written")
+    parser.add_argument("--baseline", help="results of a previous run to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--runs", type=int, default=20)
+    parser.add_argument("--takes", type=int, default=5000)
+    parser.add_argument("--lookups", type=int, default=2000)
+    parser.add_argument("--batch-size", type=int, default=20)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[2**14, 2**17, 2**20])
+    parser.add_argument("--fills", type=float, nargs="+", default=[0.1, 0.5])
+    parser.add_argument(
+        "--revoked",
+        type=float,
+        default=0.05,
+        help="fraction of the taken indexes revoked in the synthetic lists",
+    )
+    parser.add_argument("--renewal-lists", type=int, default=50)
+    parser.add_argument("--renewal-size", type=int, default=2**17)
+    parser.add_argument("--renewal-runs", type=int, default=3)
+    parser.add_argument("--verbose", action="store_true")
+    return parser.parse_args(argv)
+
+
+def main(argv=None) -> int:
+    args = parse_arguments(argv)
+    rng = random.Random(args.seed)
+    environment.setup(args.verbose)
+
+    # Created first, as in the service, the journal of this process is replayed
+    # when the application is created
+    from app import create_app
+
+    client = create_app().test_client()
+
+    results = {}
+    # First, so that only its synthetic lists are renewed
+    results.update(bench_renewal(args, rng))
+    results.update(bench_take(args))
+    results.update(bench_formats(args, rng))
+    results.update(bench_lookups(args, client, rng))
+    results.update(bench_set(args, client))
+
+    report = {
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "parameters": {
+            name: value
+            for name, value in vars(args).items()
+            if name not in ("output", "baseline", "verbose")
+        },
+        "results": results,
+    }
+
+    output = json.dumps(report, indent=2)
+
+    if args.output:
+        with open(args.output, "w") as file:
+            file.write(output)
+    elif not args.baseline:
+        print(output)
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)["results"]
+
+        if compare(results, baseline, args.tolerance):
+            return 1
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,117 @@
+# coding: latin-1
+###############################################################################
+# Copyright (c) 2023 European Commission
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+###############################################################################
+"""
+Throwaway environment of the benchmarks: a temporary status_list_dir and
+backup_dir, and a freshly generated EC key and certificate used by every country.
+"""
+import atexit
+import datetime
+import logging
+import os
+import shutil
+import tempfile
+
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.x509.oid import NameOID
+
+from app.config_service import ConfService as cfgservice
+
+API_KEY = "benchmark"
+
+COUNTRY = "FC"
+
+DOCTYPE = "eu.europa.ec.eudi.pid.1"
+
+
+def _write_signing_material(base: str) -> tuple:
+    """
+    Generates a P-256 key and a self signed certificate
+
+    Args:
+        base (str): directory where the files are written
+
+    Returns:
+        tuple: paths of the PEM private key and of the DER certificate
+    """
+
+    key = ec.generate_private_key(ec.SECP256R1())
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, "benchmark")])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    certificate = (
+        x509.CertificateBuilder()
+        .subject_name(name)
+        .issuer_name(name)
+        .public_key(key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now)
+        .not_valid_after(now + datetime.timedelta(days=1))
+        .sign(key, hashes.SHA256())
+    )
+
+    key_path = os.path.join(base, "privKey.pem")
+    cert_path = os.path.join(base, "cert.der")
+
+    with open(key_path, "wb") as file:
+        file.write(
+            key.private_bytes(
+                serialization.Encoding.PEM,
+                serialization.PrivateFormat.PKCS8,
+                serialization.NoEncryption(),
+            )
+        )
+
+    with open(cert_path, "wb") as file:
+        file.write(certificate.public_bytes(serialization.Encoding.DER))
+
+    return key_path, cert_path
+
+
+def setup(verbose: bool = False) -> str:
+    """
+    Points the service at a temporary directory and throwaway keys. Must be called
+    before the application is created: the directory is removed at exit, after
+    the exit handlers of the service have published and saved the lists.
+
+    Args:
+        verbose (bool): whether the service keeps logging at info level
+
+    Returns:
+        str: the temporary directory
+    """
+
+    base = tempfile.mkdtemp(prefix="tsl_benchmark_")
+    atexit.register(shutil.rmtree, base, ignore_errors=True)
+    key_path, cert_path = _write_signing_material(base)
+
+    for country_config in cfgservice.countries.values():
+        country_config["privKey"] = key_path
+        country_config["privkey_passwd"] = None
+        country_config["cert"] = cert_path
+
+    cfgservice.status_list_dir = os.path.join(base, "status_lists")
+    cfgservice.backup_dir = os.path.join(base, "backup")
+    os.makedirs(cfgservice.status_list_dir)
+
+    os.environ["API_key"] = API_KEY
+
+    if not verbose:
+        cfgservice.app_logger.setLevel(logging.WARNING)
+
+    return base
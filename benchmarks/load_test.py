@@ -0,0 +1,415 @@
+# coding: latin-1
+###############################################################################
+# Copyright (c) 2023 European Commission
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+###############################################################################
+"""
+Load generator simulating issuers and verifiers.
+
+Issuers take indexes in bursts of /take requests across countries and doctypes,
+and revoke a few of them with /set. Verifiers check statuses with /get and fetch
+the signed lists, as JWT or CWT, revalidating them with their ETag.
+
+Run from the root of the repository, against the application in process, with
+throwaway keys and a temporary status_list_dir:
+
+    python -m benchmarks.load_test --duration 30 --concurrency 8
+
+or against a running service, using its keys and lists:
+
+    python -m benchmarks.load_test --url http://127.0.0.1:5000 --api-key test
+"""
+import argparse
+import json
+import random
+import statistics
+import sys
+import threading
+import time
+from datetime import datetime
+from functools import partial
+from urllib.parse import urlparse
+
+from benchmarks import environment
+
+# Relative weights of the operations of the simulated traffic
+DEFAULT_MIX = {"take": 5, "set": 1, "get": 50, "artifact": 44}
+
+ARTIFACT_TYPES = {
+    "token_status_list": ("application/statuslist+jwt", "application/statuslist+cwt"),
+    "identifier_list": (
+        "application/identifierlist+jwt",
+        "application/identifierlist+cwt",
+    ),
+}
+
+
+class TestClientTransport:
+    """Sends the requests to the application in process, through its test client"""
+
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def request(self, method: str, path: str, **kwargs) -> tuple:
+        response = self.client.open(path, method=method, **kwargs)
+        return response.status_code, response.headers, response.get_data()
+
+
+class HttpTransport:
+    """Sends the requests to a running service"""
+
+    def __init__(self, url: str):
+        import requests
+
+        self.url = url.rstrip("/")
+        self.session = requests.Session()
+
+    def request(self, method: str, path: str, query_string=None, **kwargs) -> tuple:
+        response = self.session.request(
+            method, self.url + path, params=query_string, **kwargs
+        )
+        return response.status_code, response.headers, response.content
+
+
+class Recorder:
+    """Durations and errors of the requests, by operation"""
+
+    def __init__(self):
+        self.durations = {}
+        self.errors = {}
+        self.lock = threading.Lock()
+
+    def record(self, operation: str, duration: float, error: bool):
+        with self.lock:
+            self.durations.setdefault(operation, []).append(duration)
+            if error:
+                self.errors[operation] = self.errors.get(operation, 0) + 1
+
+    def summary(self, elapsed: float) -> dict:
+        """
+        Summarizes the recorded requests
+
+        Args:
+            elapsed (float): duration of the run, in seconds
+
+        Returns:
+            dict: count, throughput, error rate and latency percentiles in
+            milliseconds, by operation and for all requests
+        """
+
+        with self.lock:
+            by_operation = {
+                operation: list(durations)
+                for operation, durations in self.durations.items()
+            }
+            errors = dict(self.errors)
+
+        by_operation["all"] = [
+            duration for durations in by_operation.values() for duration in durations
+        ]
+        errors["all"] = sum(errors.values())
+
+        return {
+            operation: _summarize(durations, errors.get(operation, 0), elapsed)
+            for operation, durations in sorted(by_operation.items())
+            if durations
+        }
+
+
+def _summarize(durations: list, errors: int, elapsed: float) -> dict:
+    """Throughput, error rate and latency percentiles of an operation"""
+    ordered = sorted(durations)
+    percentiles = (
+        statistics.quantiles(ordered, n=100, method="inclusive")
+        if len(ordered) > 1
+        else None
+    )
+
+    def percentile(rank):
+        value = percentiles[rank - 1] if percentiles else ordered[0]
+        return round(value * 1000, 3)
+
+    return {
+        "requests": len(ordered),
+        "per_second": round(len(ordered) / elapsed, 1),
+        "errors": errors,
+        "error_rate": round(errors / len(ordered), 4),
+        "p50_ms": percentile(50),
+        "p95_ms": percentile(95),
+        "p99_ms": percentile(99),
+        "max_ms": round(ordered[-1] * 1000, 3),
+    }
+
+
+class Workload:
+    """
+    Traffic of a simulated population of issuers and verifiers, sharing the
+    indexes taken so far
+    """
+
+    def __init__(self, args, recorder: Recorder):
+        self.args = args
+        self.recorder = recorder
+        self.mix = args.mix
+        self.taken = []
+        self.taken_lock = threading.Lock()
+        self.headers = {"X-Api-Key": args.api_key}
+
+    def call(self, transport, operation: str, method: str, path: str, **kwargs):
+        """
+        Sends a request and records its duration
+
+        Returns:
+            tuple: status code, headers and body, or None when the request failed
+        """
+
+        start = time.perf_counter()
+        try:
+            response = transport.request(method, path, **kwargs)
+        except Exception:
+            self.recorder.record(operation, time.perf_counter() - start, True)
+            return None
+
+        self.recorder.record(operation, time.perf_counter() - start, response[0] >= 400)
+        return response
+
+    def remember(self, status_info: dict):
+        with self.taken_lock:
+            if len(self.taken) < self.args.max_remembered:
+                self.taken.append(status_info)
+            else:
+                self.taken[random.randrange(len(self.taken))] = status_info
+
+    def pick(self) -> dict:
+        with self.taken_lock:
+            return random.choice(self.taken) if self.taken else None
+
+    def take(self, transport):
+        """A burst of /take of an issuer, for a single country and doctype"""
+        data = {
+            "country": random.choice(self.args.countries),
+            "doctype": random.choice(self.args.doctypes),
+            "expiry_date": "2099-01-01",
+        }
+
+        for _ in range(random.randint(1, self.args.burst)):
+            response = self.call(
+                transport,
+                "take",
+                "POST",
+                "/token_status_list/take",
+                data=data,
+                headers=self.headers,
+            )
+            if response is not None and response[0] == 200:
+                self.remember(json.loads(response[2]))
+
+    def set(self, transport):
+        status_info = self.pick()
+        if status_info is None:
+            return
+
+        self.call(
+            transport,
+            "set",
+            "POST",
+            "/token_status_list/set",
+            data={
+                "uri": status_info["status_list"]["uri"],
+                "idx": status_info["status_list"]["idx"],
+                "status": 1,
+            },
+            headers=self.headers,
+        )
+
+    def get(self, transport):
+        status_info = self.pick()
+        if status_info is None:
+            return
+
+        list_type = random.choice(("status_list", "identifier_list"))
+        index = status_info[list_type].get("idx", status_info[list_type].get("id"))
+
+        self.call(
+            transport,
+            "get",
+            "GET",
+            "/token_status_list/get",
+            query_string={"uri": status_info[list_type]["uri"], "idx": index},
+        )
+
+    def artifact(self, transport, etags: dict):
+        """Fetch of a signed list by a verifier, revalidated when already fetched"""
+        status_info = self.pick()
+        if status_info is None:
+            return
+
+        list_type = random.choice(list(ARTIFACT_TYPES))
+        info = status_info[
+            "status_list" if list_type == "token_status_list" else list_type
+        ]
+        media_type = random.choice(ARTIFACT_TYPES[list_type])
+        path = urlparse(info["uri"]).path
+
+        headers = {"Accept": media_type}
+        if (path, media_type) in etags:
+            headers["If-None-Match"] = etags[(path, media_type)]
+
+        response = self.call(transport, "artifact", "GET", path, headers=headers)
+
+        if response is not None and response[0] == 200 and "ETag" in response[1]:
+            etags[(path, media_type)] = response[1]["ETag"]
+
+    def run(self, transport, deadline: float):
+        """Sends requests until the deadline, chosen according to the mix"""
+        operations = list(self.mix)
+        weights = [self.mix[operation] for operation in operations]
+        etags = {}
+
+        while time.monotonic() < deadline:
+            operation = random.choices(operations, weights)[0]
+
+            if operation == "artifact":
+                self.artifact(transport, etags)
+            else:
+                getattr(self, operation)(transport)
+
+
+def parse_mix(value: str) -> dict:
+    """Parses a mix given as take=5,set=1,get=50,artifact=44"""
+    mix = {}
+
+    for part in value.split(","):
+        operation, _, weight = part.partition("=")
+        if operation not in DEFAULT_MIX:
+            raise argparse.ArgumentTypeError(f"Unknown operation: {operation}")
+        mix[operation] = float(weight)
+
+    return mix
+
+
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("--url", help="service to test, instead of the application")
+    parser.add_argument("--api-key", default=environment.API_KEY)
+    parser.add_argument("--duration", type=float, default=30, help="seconds")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument(
+        "--mix",
+        type=parse_mix,
+        default=DEFAULT_MIX,
+        help="weights of the operations, as take=5,set=1,get=50,artifact=44",
+    )
+    parser.add_argument("--burst", type=int, default=10, help="most /take in a burst")
+    parser.add_argument("--countries", nargs="+", default=["FC", "PT", "EE"])
+    parser.add_argument(
+        "--doctypes",
+        nargs="+",
+        default=[
+            "eu.europa.ec.eudi.pid.1",
+            "org.iso.18013.5.1.mDL",
+            "eu.europa.ec.eudi.ehic.1",
+        ],
+    )
+    parser.add_argument("--max-remembered", type=int, default=10000)
+    parser.add_argument("--output", help="file where the results are written")
+    parser.add_argument("--seed", type=int)
+    parser.add_argument("--verbose", action="store_true")
+    return parser.parse_args(argv)
+
+
+def main(argv=None) -> int:
+    args = parse_arguments(argv)
+    random.seed(args.seed)
+
+    if args.url:
+        make_transport = partial(HttpTransport, args.url)
+    else:
+        environment.setup(args.verbose)
+
+        from app import create_app
+
+        app = create_app()
+        make_transport = partial(TestClientTransport, app)
+
+    recorder = Recorder()
+    workload = Workload(args, recorder)
+
+    # Every list gets an index before verifiers start checking them
+    transport = make_transport()
+    for country in args.countries:
+        for doctype in args.doctypes:
+            response = transport.request(
+                "POST",
+                "/token_status_list/take",
+                data={
+                    "country": country,
+                    "doctype": doctype,
+                    "expiry_date": "2099-01-01",
+                },
+                headers=workload.headers,
+            )
+            if response[0] != 200:
+                print(f"Unable to take an index: {response[2][:200]}")
+                return 1
+            workload.remember(json.loads(response[2]))
+
+    start = time.monotonic()
+    deadline = start + args.duration
+    workers = [
+        threading.Thread(target=workload.run, args=(make_transport(), deadline))
+        for _ in range(args.concurrency)
+    ]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.monotonic() - start
+
+    results = recorder.summary(elapsed)
+
+    print(
+        f"{'operation':10} {'requests':>9} {'req/s':>9} {'errors':>7} "
+        f"{'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'max ms':>9}"
+    )
+    for operation, result in results.items():
+        print(
+            f"{operation:10} {result['requests']:9} {result['per_second']:9} "
+            f"{result['error_rate']:7.2%} {result['p50_ms']:9} {result['p95_ms']:9} "
+            f"{result['p99_ms']:9} {result['max_ms']:9}"
+        )
+
+    if args.output:
+        report = {
+            "created": datetime.now().isoformat(timespec="seconds"),
+            "target": args.url or "application",
+            "parameters": {
+                "duration": args.duration,
+                "concurrency": args.concurrency,
+                "mix": args.mix,
+                "burst": args.burst,
+                "countries": args.countries,
+                "doctypes": args.doctypes,
+            },
+            "results": results,
+        }
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=2)
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())